@@ -0,0 +1,45 @@
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Iterable
+
+
+class TTLCache[K, V]:
+    """Thread-safe in-process LRU cache whose entries also expire after ``ttl``."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict[K, tuple[float, V]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: K) -> V | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: K, value: V) -> None:
+        self.set_many([(key, value)])
+
+    def set_many(self, items: Iterable[tuple[K, V]]) -> None:
+        expires_at = time.monotonic() + self.ttl
+        with self._lock:
+            for key, value in items:
+                self._entries[key] = (expires_at, value)
+                self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
@@ -1,7 +1,14 @@
+from typing import Any
+
+from billiard.process import current_process
 from celery import Celery
 from celery.app.task import Task
+from celery.signals import task_postrun, task_prerun, worker_process_init
+from prometheus_client import start_http_server
 
 from api.core.config import settings
+from api.db.database import dispose_engines
+from api.db.queries import QueryScope
 
 # Monkey patch recommended by celery-types
 Task.__class_getitem__ = classmethod(lambda cls, *args, **kwargs: cls)  # type: ignore[attr-defined]
@@ -24,3 +31,51 @@ app = Celery(
 app.conf.result_backend_transport_options = {
     "global_keyprefix": settings.REDIS_PREFIX + "celery:"
 }
+
+# Open query scopes by task ID
+_task_query_scopes: dict[str, QueryScope] = {}
+
+app.conf.beat_schedule = {
+    "refresh-gocardless-token": {
+        "task": "api.tasks.gocardless.refresh_gocardless_token",
+        "schedule": settings.GOCARDLESS_TOKEN_REFRESH_INTERVAL,
+    },
+    "detect-recurring-series": {
+        "task": "api.tasks.recurring.detect_recurring_series",
+        "schedule": settings.RECURRING_DETECTION_INTERVAL,
+    },
+    "create-transaction-partitions": {
+        "task": "api.tasks.partitions.create_transaction_partitions",
+        "schedule": settings.TRANSACTION_PARTITION_INTERVAL,
+    },
+}
+
+
+@worker_process_init.connect
+def reset_db_pools(**kwargs: Any) -> None:
+    # Connections opened before the fork belong to the parent process
+    dispose_engines()
+
+
+@worker_process_init.connect
+def start_metrics_server(**kwargs: Any) -> None:
+    if settings.WORKER_METRICS_PORT is None:
+        return
+
+    # Every pool process keeps its own registry, so each gets its own port
+    index = getattr(current_process(), "index", 0)
+    start_http_server(settings.WORKER_METRICS_PORT + index)
+
+
+@task_prerun.connect
+def open_task_query_scope(task_id: str, task: Task, **kwargs: Any) -> None:
+    budget = getattr(task, "query_budget", settings.DATABASE_TASK_QUERY_BUDGET)
+    scope = QueryScope("task", task.name, budget)
+    _task_query_scopes[task_id] = scope.__enter__()
+
+
+@task_postrun.connect
+def close_task_query_scope(task_id: str, **kwargs: Any) -> None:
+    scope = _task_query_scopes.pop(task_id, None)
+    if scope is not None:
+        scope.close()
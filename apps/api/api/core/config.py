@@ -6,6 +6,33 @@ from pydantic_settings import BaseSettings, SettingsConfigDict
 class Settings(BaseSettings):
     APP_URL: str = "http://localhost:3000"
     DATABASE_URL: str = "sqlite:///./dev.db"
+    # Request path engine, defaults to DATABASE_URL with an asyncio driver
+    ASYNC_DATABASE_URL: str | None = None
+    # Read replicas as a JSON list, reads fall back to the primary while every
+    # replica is unreachable or lags more than MAX_LAG seconds
+    DATABASE_REPLICA_URLS: list[str] = []
+    DATABASE_REPLICA_MAX_LAG: float = 5.0
+    DATABASE_REPLICA_LAG_CHECK_INTERVAL: float = 5.0
+    # Statements a request or task may issue before it is reported, a task can
+    # override this with a query_budget option. STRICT fails the statement that
+    # exceeds the budget instead, for tests
+    DATABASE_REQUEST_QUERY_BUDGET: int | None = 50
+    DATABASE_TASK_QUERY_BUDGET: int | None = 1000
+    DATABASE_QUERY_BUDGET_STRICT: bool = False
+    # Logs every statement synchronously, development only
+    DATABASE_ECHO: bool = False
+    # Connections kept open per process, plus up to MAX_OVERFLOW under load
+    DATABASE_POOL_SIZE: int = 5
+    DATABASE_MAX_OVERFLOW: int = 10
+    # Seconds a checkout waits for a free connection before failing
+    DATABASE_POOL_TIMEOUT: float = 30.0
+    # Connections older than this are replaced on checkout
+    DATABASE_POOL_RECYCLE: int = 60 * 30
+    # Server side limit per statement of the request path, in milliseconds
+    DATABASE_STATEMENT_TIMEOUT: int = 30 * 1000
+    # Same for Celery tasks, whose bulk merges and scans may run far longer,
+    # unlimited while unset
+    DATABASE_TASK_STATEMENT_TIMEOUT: int | None = None
 
     SIGNUP_ENABLED: bool = True
 
@@ -38,6 +65,40 @@ class Settings(BaseSettings):
     # GoCardless configuration
     GOCARDLESS_SECRET_ID: str = "dev-id"
     GOCARDLESS_SECRET_KEY: str = "dev-key"
+    GOCARDLESS_CONNECT_TIMEOUT: float = 5.0
+    GOCARDLESS_READ_TIMEOUT: float = 30.0
+    GOCARDLESS_POOL_SIZE: int = 10
+    # Longest a request sleeps for rate limit quota before the task reschedules
+    GOCARDLESS_RATE_LIMIT_MAX_WAIT: float = 10.0
+    # Background refresh runs every INTERVAL and renews tokens expiring within AHEAD
+    GOCARDLESS_TOKEN_REFRESH_INTERVAL: int = 60 * 5
+    GOCARDLESS_TOKEN_REFRESH_AHEAD: int = 60 * 15
+    # Days re-fetched before the sync watermark to catch late-booked transactions
+    GOCARDLESS_SYNC_OVERLAP_DAYS: int = 7
+
+    # Celery pool processes serve their metrics on this port plus their index
+    WORKER_METRICS_PORT: int | None = None
+    # Bearer token for the API's /metrics endpoint, which is hidden while unset
+    METRICS_TOKEN: str | None = None
+
+    # Transaction processing
+    # Largest booking time difference between the two sides of a transfer
+    TRANSFER_MATCH_WINDOW_DAYS: int = 3
+    # Seconds to collect enrichment requests for an account before one run
+    PROCESSING_DEBOUNCE: float = 5.0
+    PROCESSING_BATCH_SIZE: int = 5000
+    # Per-account run lease, renewed after every batch
+    PROCESSING_LEASE_TIMEOUT: int = 60 * 5
+    RECURRING_DETECTION_INTERVAL: int = 60 * 60
+    # Overlap of detection runs, covers writes committed after a run started
+    # whose updated_at, their transaction start, is older than the run
+    RECURRING_WATERMARK_MARGIN: int = 60 * 15
+    # Monthly transaction partitions kept from BEHIND months back, covering the
+    # two years of history banks serve, through AHEAD months ahead, checked
+    # every INTERVAL
+    TRANSACTION_PARTITIONS_BEHIND: int = 25
+    TRANSACTION_PARTITIONS_AHEAD: int = 3
+    TRANSACTION_PARTITION_INTERVAL: int = 60 * 60 * 24
 
     model_config = SettingsConfigDict(
         env_file=".env",
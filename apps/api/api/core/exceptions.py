@@ -59,6 +59,33 @@ class GoCardlessAPIError(GoCardlessException):
         super().__init__(message, error_code)
 
 
+class GoCardlessRateLimitError(GoCardlessAPIError):
+    """Raised when a GoCardless rate limit is exhausted."""
+
+    def __init__(
+        self,
+        operation: str,
+        retry_after: float,
+        response_text: str = "",
+        status_code: int | None = None,
+        message: str | None = None,
+        error_code: str | None = None,
+    ):
+        self.retry_after = retry_after
+        if message is None:
+            message = (
+                f"Rate limit exhausted, cannot {operation} "
+                f"for another {retry_after:.0f}s"
+            )
+        super().__init__(
+            operation,
+            response_text,
+            status_code=status_code,
+            message=message,
+            error_code=error_code,
+        )
+
+
 class ConnectionImportException(KoruBaseException):
     """Raised when there are issues with GoCardless connections."""
 
@@ -95,3 +122,26 @@ class ConnectionMissingDataError(ConnectionImportException):
         if message is None:
             message = f"GoCardless connection {connection_id} has no {missing_field}"
         super().__init__(message, error_code)
+
+
+class DatabaseException(KoruBaseException):
+    """Raised when there are issues with database usage."""
+
+    pass
+
+
+class QueryBudgetExceededError(DatabaseException):
+    """Raised when a request or task issues more statements than its budget."""
+
+    def __init__(
+        self,
+        scope: str,
+        budget: int,
+        message: str | None = None,
+        error_code: str | None = None,
+    ):
+        self.scope = scope
+        self.budget = budget
+        if message is None:
+            message = f"{scope} exceeded its budget of {budget} statements"
+        super().__init__(message, error_code)
@@ -1,7 +1,24 @@
+import os
+import time
+from collections.abc import Generator, Iterator
+from contextlib import suppress
+from datetime import date
+from functools import lru_cache
+from itertools import islice
+from typing import Any
+
 import requests
+from prometheus_client import Counter, Histogram
+from redis.exceptions import LockError
+from requests.adapters import HTTPAdapter
 
 from api.core.config import settings
-from api.core.exceptions import GoCardlessAPIError
+from api.core.exceptions import (
+    GoCardlessAPIError,
+    GoCardlessException,
+    GoCardlessRateLimitError,
+)
+from api.core.metrics import CallbackGauge
 from api.schemas.gocardless import (
     AccountDetails,
     AccountDetailsResponse,
@@ -15,208 +32,510 @@ from api.schemas.gocardless import (
     TransactionsResponse,
 )
 
+from . import ratelimit
+from .cache import TTLCache
 from .redis import redis_client
+from .streaming import iter_json_array
 
 GOCARDLESS_URL = "https://bankaccountdata.gocardless.com/api/v2"
 TOKEN_EXPIRY_BUFFER = 60
+TOKEN_LOCK_TIMEOUT = 30
+TRANSACTIONS_BATCH_SIZE = 500
+STREAM_CHUNK_SIZE = 64 * 1024
+RATE_LIMIT_DEFAULT_RETRY = 60
+INSTITUTIONS_CACHE_TTL = 60 * 60 * 24
+INSTITUTIONS_LOCAL_TTL = 60 * 60
+
+# In-process layer in front of the Redis institution cache
+_institutions: TTLCache[str, Institution] = TTLCache(
+    maxsize=4096, ttl=INSTITUTIONS_LOCAL_TTL
+)
+_institution_lists: TTLCache[str | None, list[Institution]] = TTLCache(
+    maxsize=64, ttl=INSTITUTIONS_LOCAL_TTL
+)
+
+TOKEN_KEY = f"{settings.REDIS_PREFIX}gocardless:token"
+REFRESH_TOKEN_KEY = f"{settings.REDIS_PREFIX}gocardless:refresh_token"
+TOKEN_LOCK_KEY = f"{settings.REDIS_PREFIX}gocardless:token:lock"
+
+
+@lru_cache
+def get_http_session() -> requests.Session:
+    """
+    Shared keep-alive session for all GoCardless calls in this process.
+
+    The pool blocks instead of opening more than GOCARDLESS_POOL_SIZE
+    connections, so concurrent callers queue for a warm connection rather than
+    paying for a fresh TLS handshake each.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=settings.GOCARDLESS_POOL_SIZE,
+        pool_block=True,
+    )
+    session.mount("https://", adapter)
+    return session
+
+
+# Celery prefork children must not share the parent's sockets
+os.register_at_fork(after_in_child=get_http_session.cache_clear)
+
+
+def _pool_stats() -> list[tuple[dict[str, str], float]]:
+    if get_http_session.cache_info().currsize == 0:
+        return []
+
+    adapter = get_http_session().get_adapter(GOCARDLESS_URL)
+    assert isinstance(adapter, HTTPAdapter)
+
+    stats: list[tuple[dict[str, str], float]] = []
+    # The pool container is not iterable, keys() takes a locked snapshot
+    for key in adapter.poolmanager.pools.keys():  # noqa: SIM118
+        pool = adapter.poolmanager.pools[key]
+        host = str(key.key_host)
+        stats.append(({"host": host, "stat": "connections"}, pool.num_connections))
+        stats.append(({"host": host, "stat": "requests"}, pool.num_requests))
+        idle = pool.pool.qsize() if pool.pool is not None else 0
+        stats.append(({"host": host, "stat": "idle"}, idle))
+    return stats
+
+
+HTTP_REQUESTS = Counter(
+    "gocardless_http_requests",
+    "GoCardless API requests by operation and response status.",
+    ["operation", "status"],
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "gocardless_http_request_seconds",
+    "GoCardless API request latency until response headers arrive.",
+    ["operation"],
+)
+HTTP_POOL = CallbackGauge(
+    "gocardless_http_pool",
+    "Connections opened, requests served and idle connections per host pool.",
+    ["host", "stat"],
+    _pool_stats,
+)
+
+
+def _request(
+    method: str,
+    path: str,
+    operation: str,
+    *,
+    scope: str,
+    token: str | None = None,
+    account_id: str | None = None,
+    **kwargs: Any,
+) -> requests.Response:
+    """
+    Send a request once its rate limit scopes have quota left.
+
+    ``scope`` names the endpoint quota, requests for an ``account_id`` also
+    count against that account's quota for the endpoint.
+    """
+    # (bucket, prefix of the headers reporting its quota)
+    buckets = [(f"endpoint:{scope}", "X_RATELIMIT_")]
+    if account_id:
+        buckets.append(
+            (f"account:{account_id}:{scope}", "X_RATELIMIT_ACCOUNT_SUCCESS_")
+        )
+
+    ratelimit.acquire(operation, [bucket for bucket, _ in buckets])
+
+    headers = {"Authorization": f"Bearer {token}"} if token else None
+
+    start = time.perf_counter()
+    try:
+        response = get_http_session().request(
+            method,
+            f"{GOCARDLESS_URL}{path}",
+            headers=headers,
+            timeout=(
+                settings.GOCARDLESS_CONNECT_TIMEOUT,
+                settings.GOCARDLESS_READ_TIMEOUT,
+            ),
+            **kwargs,
+        )
+    except requests.RequestException:
+        HTTP_REQUESTS.labels(operation=operation, status="error").inc()
+        raise
+    finally:
+        HTTP_REQUEST_SECONDS.labels(operation=operation).observe(
+            time.perf_counter() - start
+        )
+
+    HTTP_REQUESTS.labels(operation=operation, status=str(response.status_code)).inc()
+
+    retry_after = None
+    for bucket, header in buckets:
+        remaining = _header_number(response, f"{header}REMAINING")
+        reset = _header_number(response, f"{header}RESET")
+        if remaining is not None and reset is not None:
+            ratelimit.update(bucket, int(remaining), reset)
+            if remaining <= 0:
+                retry_after = max(retry_after or 0, reset)
+
+    if response.status_code == 429:
+        if retry_after is None:
+            # No quota headers, hold back the whole endpoint
+            retry_after = (
+                _header_number(response, "RETRY_AFTER") or RATE_LIMIT_DEFAULT_RETRY
+            )
+            ratelimit.update(buckets[0][0], 0, retry_after)
+
+        raise GoCardlessRateLimitError(
+            operation,
+            retry_after,
+            response.text,
+            status_code=response.status_code,
+        )
+
+    if not response.ok:
+        raise GoCardlessAPIError(
+            operation,
+            response.text,
+            status_code=response.status_code,
+        )
+
+    return response
+
+
+def _header_number(response: requests.Response, name: str) -> float | None:
+    # GoCardless prefixes its rate limit headers with HTTP_, accept both forms
+    for header in (f"HTTP_{name}", name.replace("_", "-")):
+        value = response.headers.get(header)
+        if value is not None:
+            try:
+                return float(value)
+            except ValueError:
+                return None
+
+    return None
 
 
 def get_token() -> str:
-    token = redis_client.get(f"{settings.REDIS_PREFIX}gocardless:token")
+    token = redis_client.get(TOKEN_KEY)
 
     if token:
         assert isinstance(token, str)
 
         return token
 
-    refresh_token = redis_client.get(f"{settings.REDIS_PREFIX}gocardless:refresh_token")
+    return refresh_token()
+
+
+def refresh_token(min_ttl: int = 0) -> str:
+    """
+    Mint a new access token unless the cached one outlives ``min_ttl`` seconds.
+
+    Only one process refreshes at a time, everyone else blocks on the Redis
+    lock and then picks up the token the holder stored.
+    """
+    lock = redis_client.lock(
+        TOKEN_LOCK_KEY,
+        timeout=TOKEN_LOCK_TIMEOUT,
+        blocking_timeout=TOKEN_LOCK_TIMEOUT,
+    )
+
+    if not lock.acquire():
+        raise GoCardlessException("Timed out waiting for GoCardless token refresh")
+
+    try:
+        token = redis_client.get(TOKEN_KEY)
+        if token and redis_client.ttl(TOKEN_KEY) > min_ttl:
+            assert isinstance(token, str)
+
+            return token
+
+        return _mint_token()
+    finally:
+        with suppress(LockError):
+            lock.release()
 
-    if refresh_token:
-        response = requests.post(
-            f"{GOCARDLESS_URL}/token/refresh/",
-            data={
-                "refresh": refresh_token,
-            },
-        )
 
-        if not response.ok:
-            raise GoCardlessAPIError(
+def _mint_token() -> str:
+    refresh = redis_client.get(REFRESH_TOKEN_KEY)
+
+    if refresh:
+        try:
+            response = _request(
+                "POST",
+                "/token/refresh/",
                 "refresh GoCardless token",
-                response.text,
-                status_code=response.status_code,
+                scope="token",
+                data={
+                    "refresh": refresh,
+                },
             )
+        except GoCardlessAPIError as e:
+            if e.status_code != 401:
+                raise
+
+            # Refresh token was revoked, fall through to a new token pair
+            redis_client.delete(REFRESH_TOKEN_KEY)
+        else:
+            refreshed = RefreshResponse.model_validate_json(response.text)
+            redis_client.set(
+                TOKEN_KEY,
+                refreshed.access,
+                refreshed.access_expires - TOKEN_EXPIRY_BUFFER,
+            )
+            return refreshed.access
 
-        token = RefreshResponse.model_validate_json(response.text)
-        redis_client.set(
-            f"{settings.REDIS_PREFIX}gocardless:token",
-            token.access,
-            token.access_expires - TOKEN_EXPIRY_BUFFER,
-        )
-        return token.access
-
-    response = requests.post(
-        f"{GOCARDLESS_URL}/token/new/",
+    response = _request(
+        "POST",
+        "/token/new/",
+        "create GoCardless token",
+        scope="token",
         data={
             "secret_id": settings.GOCARDLESS_SECRET_ID,
             "secret_key": settings.GOCARDLESS_SECRET_KEY,
         },
     )
 
-    if not response.ok:
-        raise GoCardlessAPIError(
-            "create GoCardless token",
-            response.text,
-            status_code=response.status_code,
-        )
-
     token = TokenResponse.model_validate_json(response.text)
-    redis_client.set(
-        f"{settings.REDIS_PREFIX}gocardless:token",
+
+    pipeline = redis_client.pipeline()
+    pipeline.set(
+        TOKEN_KEY,
         token.access,
         token.access_expires - TOKEN_EXPIRY_BUFFER,
     )
-
-    redis_client.set(
-        f"{settings.REDIS_PREFIX}gocardless:refresh_token",
+    pipeline.set(
+        REFRESH_TOKEN_KEY,
         token.refresh,
         token.refresh_expires - TOKEN_EXPIRY_BUFFER,
     )
+    pipeline.execute()
 
     return token.access
 
 
-def get_institutions(country: str | None = None) -> list[Institution]:
-    value = redis_client.get(
+def _institutions_key(country: str | None) -> str:
+    return (
         f"{settings.REDIS_PREFIX}gocardless:institutions"
         f"{f':{country}' if country else ''}"
     )
 
-    if value:
-        return InstitutionsResponse.validate_json(value)
 
-    token = get_token()
-    response = requests.get(
-        f"{GOCARDLESS_URL}/institutions/",
-        headers={"Authorization": f"Bearer {token}"},
+def _institution_key(institution_id: str) -> str:
+    return f"{settings.REDIS_PREFIX}gocardless:institutions:id:{institution_id}"
+
+
+def get_institutions(country: str | None = None) -> list[Institution]:
+    cached = _institution_lists.get(country)
+
+    if cached is not None:
+        return list(cached)
+
+    value = redis_client.get(_institutions_key(country))
+
+    if value:
+        institutions = InstitutionsResponse.validate_json(value)
+        _cache_institutions_locally(country, institutions)
+        return institutions
+
+    response = _request(
+        "GET",
+        "/institutions/",
+        "fetch institutions",
+        scope="institutions",
+        token=get_token(),
         params={"country": country} if country else None,
     )
 
-    if not response.ok:
-        raise GoCardlessAPIError(
-            "fetch institutions",
-            response.text,
-            status_code=response.status_code,
-        )
-
     institutions = InstitutionsResponse.validate_json(response.text)
-    redis_client.set(
-        f"{settings.REDIS_PREFIX}gocardless:institutions"
-        f"{f':{country}' if country else ''}",
+
+    # Store the per-id entries too so single lookups never need the list
+    pipeline = redis_client.pipeline(transaction=False)
+    pipeline.set(
+        _institutions_key(country),
         InstitutionsResponse.dump_json(institutions),
-        60 * 60 * 24,
+        INSTITUTIONS_CACHE_TTL,
     )
+    for institution in institutions:
+        pipeline.set(
+            _institution_key(institution.id),
+            Institution.model_dump_json(institution),
+            INSTITUTIONS_CACHE_TTL,
+        )
+    pipeline.execute()
+
+    _cache_institutions_locally(country, institutions)
     return institutions
 
 
-def get_institution(institution_id: str) -> Institution:
-    value = redis_client.get(
-        f"{settings.REDIS_PREFIX}gocardless:institutions:id:{institution_id}"
+def _cache_institutions_locally(
+    country: str | None, institutions: list[Institution]
+) -> None:
+    _institution_lists.set(country, list(institutions))
+    _institutions.set_many(
+        (institution.id, institution) for institution in institutions
     )
 
-    if value:
-        return Institution.model_validate_json(value)
 
-    token = get_token()
-    response = requests.get(
-        f"{GOCARDLESS_URL}/institutions/{institution_id}/",
-        headers={"Authorization": f"Bearer {token}"},
-    )
+def get_institution(institution_id: str) -> Institution:
+    institution = _institutions.get(institution_id)
 
-    if not response.ok:
-        raise GoCardlessAPIError(
-            "fetch institution",
-            response.text,
-            status_code=response.status_code,
-        )
+    if institution is not None:
+        return institution
+
+    value = redis_client.get(_institution_key(institution_id))
+
+    if value:
+        institution = Institution.model_validate_json(value)
+        _institutions.set(institution_id, institution)
+        return institution
+
+    response = _request(
+        "GET",
+        f"/institutions/{institution_id}/",
+        "fetch institution",
+        scope="institutions",
+        token=get_token(),
+    )
 
     institution = Institution.model_validate_json(response.text)
     redis_client.set(
-        f"{settings.REDIS_PREFIX}gocardless:institutions:id:{institution_id}",
+        _institution_key(institution_id),
         Institution.model_dump_json(institution),
-        60 * 60 * 24,
+        INSTITUTIONS_CACHE_TTL,
     )
+    _institutions.set(institution_id, institution)
     return institution
 
 
 def create_requisition(
     institution_id: str, redirect_url: str
 ) -> CreateRequisitionResponse:
-    token = get_token()
-    response = requests.post(
-        f"{GOCARDLESS_URL}/requisitions/",
-        headers={"Authorization": f"Bearer {token}"},
+    response = _request(
+        "POST",
+        "/requisitions/",
+        "create requisition",
+        scope="requisitions",
+        token=get_token(),
         json={
             "institution_id": institution_id,
             "redirect": redirect_url,
         },
     )
 
-    if not response.ok:
-        raise GoCardlessAPIError(
-            "create requisition",
-            response.text,
-            status_code=response.status_code,
-        )
-
     return CreateRequisitionResponse.model_validate_json(response.text)
 
 
 def get_requisition(requisition_id: str) -> GetRequisitionResponse:
-    token = get_token()
-    response = requests.get(
-        f"{GOCARDLESS_URL}/requisitions/{requisition_id}/",
-        headers={"Authorization": f"Bearer {token}"},
+    response = _request(
+        "GET",
+        f"/requisitions/{requisition_id}/",
+        "fetch accounts",
+        scope="requisitions",
+        token=get_token(),
     )
 
-    if not response.ok:
-        raise GoCardlessAPIError(
-            "fetch accounts",
-            response.text,
-            status_code=response.status_code,
-        )
-
     return GetRequisitionResponse.model_validate_json(response.text)
 
 
 def get_account_details(account_id: str) -> AccountDetails:
-    token = get_token()
-    response = requests.get(
-        f"{GOCARDLESS_URL}/accounts/{account_id}/details/",
-        headers={"Authorization": f"Bearer {token}"},
+    response = _request(
+        "GET",
+        f"/accounts/{account_id}/details/",
+        "fetch account details",
+        scope="details",
+        account_id=account_id,
+        token=get_token(),
     )
 
-    if not response.ok:
-        raise GoCardlessAPIError(
-            "fetch account details",
-            response.text,
-            status_code=response.status_code,
-        )
-
     return AccountDetailsResponse.model_validate_json(response.text).account
 
 
-def get_transactions(account_id: str) -> TransactionsContainer:
-    token = get_token()
-    response = requests.get(
-        f"{GOCARDLESS_URL}/accounts/{account_id}/transactions/",
-        headers={"Authorization": f"Bearer {token}"},
+def _transaction_params(
+    date_from: date | None, date_to: date | None
+) -> dict[str, str] | None:
+    params = {}
+    if date_from:
+        params["date_from"] = date_from.isoformat()
+    if date_to:
+        params["date_to"] = date_to.isoformat()
+
+    return params or None
+
+
+def get_transactions(
+    account_id: str,
+    date_from: date | None = None,
+    date_to: date | None = None,
+) -> TransactionsContainer:
+    response = _request(
+        "GET",
+        f"/accounts/{account_id}/transactions/",
+        "fetch transactions",
+        scope="transactions",
+        account_id=account_id,
+        token=get_token(),
+        params=_transaction_params(date_from, date_to),
     )
 
-    if not response.ok:
-        raise GoCardlessAPIError(
-            "fetch transactions",
-            response.text,
-            status_code=response.status_code,
+    return TransactionsResponse.model_validate_json(response.text).transactions
+
+
+class TransactionBatches:
+    """
+    Booked transactions of a streamed response, parsed in batches on iteration.
+
+    Closing it, or leaving its ``with`` block, releases the connection even if
+    iteration never started.
+    """
+
+    def __init__(self, response: requests.Response, batch_size: int):
+        self._response = response
+        self._batches = self._iter_batches(batch_size)
+
+    def _iter_batches(self, batch_size: int) -> Generator[list[Any]]:
+        items = iter_json_array(
+            self._response.iter_content(chunk_size=STREAM_CHUNK_SIZE),
+            ("transactions", "booked"),
         )
 
-    return TransactionsResponse.model_validate_json(response.text).transactions
+        while batch := list(islice(items, batch_size)):
+            # Validates the slice as TransactionsContainer.booked
+            yield TransactionsContainer.model_validate({"booked": batch}).booked
+
+    def __iter__(self) -> Iterator[list[Any]]:
+        return self._batches
+
+    def __enter__(self) -> "TransactionBatches":
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._batches.close()
+        self._response.close()
+
+
+def stream_transactions(
+    account_id: str,
+    date_from: date | None = None,
+    date_to: date | None = None,
+    batch_size: int = TRANSACTIONS_BATCH_SIZE,
+) -> TransactionBatches:
+    """
+    Fetch booked transactions, yielding validated batches while the body streams.
+
+    The request is sent immediately, the body is parsed as it is iterated.
+    """
+    response = _request(
+        "GET",
+        f"/accounts/{account_id}/transactions/",
+        "fetch transactions",
+        scope="transactions",
+        account_id=account_id,
+        token=get_token(),
+        params=_transaction_params(date_from, date_to),
+        stream=True,
+    )
+
+    return TransactionBatches(response, batch_size)
@@ -0,0 +1,187 @@
+import threading
+from collections import defaultdict
+from collections.abc import Iterable, Sequence
+from datetime import datetime, timedelta
+from typing import Any
+
+from sqlmodel import Session, col, func, select
+
+from api.core.normalize import normalize_name
+from api.models.account import Account
+from api.models.merchant import Merchant
+
+
+class _Node:
+    __slots__ = ("children", "value")
+
+    def __init__(self) -> None:
+        self.children: dict[str, _Node] = {}
+        self.value: str | None = None
+
+
+class PrefixMatcher:
+    """
+    Case-insensitive longest-prefix lookup over a fixed set of prefixes.
+
+    Lookups walk at most ``len(text)`` trie nodes, independent of how many
+    prefixes were added. When two entries share a prefix the first one wins.
+    """
+
+    def __init__(self, entries: Iterable[tuple[str, str]]):
+        self._root = _Node()
+        self.size = 0
+
+        for prefix, value in entries:
+            node = self._root
+            for char in prefix.casefold():
+                node = node.children.setdefault(char, _Node())
+            if node.value is None:
+                node.value = value
+                self.size += 1
+
+    def match(self, text: str) -> str | None:
+        """Return the value of the longest prefix of ``text``, if any."""
+        node = self._root
+        best = node.value
+        for char in text.casefold():
+            next_node = node.children.get(char)
+            if next_node is None:
+                break
+            node = next_node
+            if node.value is not None:
+                best = node.value
+        return best
+
+    def match_many(self, texts: Iterable[str]) -> list[str | None]:
+        return [self.match(text) for text in texts]
+
+
+class AccountMatcher:
+    """
+    In-memory IBAN/BBAN lookup over one user's accounts.
+
+    Follows the same rule as the SQL linking: a transaction is linked only
+    when exactly one account has its IBAN or its BBAN.
+    """
+
+    def __init__(self, accounts: Iterable[tuple[str, str | None, str | None]]):
+        self._by_iban: dict[str, set[str]] = defaultdict(set)
+        self._by_bban: dict[str, set[str]] = defaultdict(set)
+
+        for account_id, iban, bban in accounts:
+            if iban is not None:
+                self._by_iban[iban].add(account_id)
+            if bban is not None:
+                self._by_bban[bban].add(account_id)
+
+    def match(self, iban: str | None, bban: str | None) -> str | None:
+        candidates: set[str] = set()
+        if iban is not None:
+            candidates |= self._by_iban.get(iban, set())
+        if bban is not None:
+            candidates |= self._by_bban.get(bban, set())
+
+        if len(candidates) == 1:
+            return next(iter(candidates))
+        return None
+
+
+def get_account_matcher(session: Session, user_id: str) -> AccountMatcher:
+    """Load the accounts owned by ``user_id`` into an AccountMatcher."""
+    accounts = session.exec(
+        select(Account.id, Account.iban, Account.bban).where(Account.user_id == user_id)
+    ).all()
+    return AccountMatcher(accounts)
+
+
+def pair_transfers(
+    transactions: Sequence[Any], candidates: Sequence[Any], window: timedelta
+) -> list[tuple[str, str]]:
+    """
+    Pair transactions with candidates of the opposite amount in the same
+    currency, booked at most ``window`` apart. The closest candidate in time
+    wins and each candidate is used at most once.
+
+    Rows need ``id``, ``currency``, ``amount`` and ``booking_time``. Both sides
+    are sorted by (currency, abs(amount), booking_time) and merged, so the cost
+    is linear in the rows plus the candidates inside each window.
+    """
+
+    def sort_key(row: Any) -> tuple[str, float, datetime]:
+        return (row.currency, round(abs(row.amount), 2), row.booking_time)
+
+    transactions = sorted(transactions, key=sort_key)
+    candidate_keys = [sort_key(candidate) for candidate in candidates]
+    order = sorted(range(len(candidates)), key=candidate_keys.__getitem__)
+    candidates = [candidates[i] for i in order]
+    candidate_keys = [candidate_keys[i] for i in order]
+
+    pairs = []
+    used: set[str] = set()
+    start = 0
+    for row in transactions:
+        currency, amount, booking_time = sort_key(row)
+        earliest = (currency, amount, booking_time - window)
+        latest = (currency, amount, booking_time + window)
+
+        # Rows are visited in key order, so the window start only moves forward
+        while start < len(candidates) and candidate_keys[start] < earliest:
+            start += 1
+
+        best = None
+        index = start
+        while index < len(candidates) and candidate_keys[index] <= latest:
+            candidate = candidates[index]
+            index += 1
+            if candidate.id in used or (candidate.amount < 0) == (row.amount < 0):
+                continue
+            if best is None or abs(candidate.booking_time - booking_time) < abs(
+                best.booking_time - booking_time
+            ):
+                best = candidate
+
+        if best is not None:
+            used.add(best.id)
+            pairs.append((row.id, best.id))
+
+    return pairs
+
+
+# Per-process merchant matcher, keyed by a version of the merchant table
+_merchant_matcher: tuple[tuple[int, datetime | None], PrefixMatcher] | None = None
+_merchant_matcher_lock = threading.Lock()
+
+
+def get_merchant_matcher(session: Session) -> PrefixMatcher:
+    """
+    Return a matcher from normalized ``Merchant.match_prefix`` to merchant IDs.
+
+    Names must be passed through normalize_name before matching.
+
+    The matcher is rebuilt only when the merchant count or the latest
+    ``updated_at`` changed since it was last built in this process.
+    """
+    global _merchant_matcher
+
+    count, updated_at = session.exec(
+        select(func.count(col(Merchant.id)), func.max(Merchant.updated_at))
+    ).one()
+    version = (count, updated_at)
+
+    with _merchant_matcher_lock:
+        if _merchant_matcher is not None and _merchant_matcher[0] == version:
+            return _merchant_matcher[1]
+
+        merchants = session.exec(
+            select(
+                Merchant.match_prefix_normalized, Merchant.match_prefix, Merchant.id
+            ).order_by(col(Merchant.id))
+        ).all()
+        matcher = PrefixMatcher(
+            (prefix, merchant_id)
+            for normalized_prefix, match_prefix, merchant_id in merchants
+            # An empty prefix would match every name
+            if (prefix := normalized_prefix or normalize_name(match_prefix))
+        )
+        _merchant_matcher = (version, matcher)
+        return matcher
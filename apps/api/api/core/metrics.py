@@ -0,0 +1,41 @@
+from collections.abc import Callable, Iterable, Iterator, Sequence
+
+from prometheus_client import REGISTRY, CollectorRegistry
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.registry import Collector
+
+GaugeSamples = Iterable[tuple[dict[str, str], float]]
+
+
+class CallbackGauge(Collector):
+    """
+    Gauge computed at collection time, for state owned by other objects such
+    as connection pools.
+
+    ``callback`` returns ``(labels, value)`` pairs, one per labelled sample.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str],
+        callback: Callable[[], GaugeSamples],
+        registry: CollectorRegistry = REGISTRY,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = list(labelnames)
+        self.callback = callback
+        registry.register(self)
+
+    def describe(self) -> Iterator[GaugeMetricFamily]:
+        yield GaugeMetricFamily(self.name, self.documentation, labels=self.labelnames)
+
+    def collect(self) -> Iterator[GaugeMetricFamily]:
+        family = GaugeMetricFamily(
+            self.name, self.documentation, labels=self.labelnames
+        )
+        for labels, value in self.callback():
+            family.add_metric([labels[name] for name in self.labelnames], value)
+        yield family
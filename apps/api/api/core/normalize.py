@@ -0,0 +1,24 @@
+import re
+
+# Card payments append location and terminal details after a double slash,
+# e.g. "REWE Markt GmbH//Berlin/DE"
+_LOCATION_SUFFIX = re.compile(r"//.*$", re.DOTALL)
+_PUNCTUATION = re.compile(r"[\W_]+")
+# Trailing store, terminal and card numbers, e.g. "rewe 4711 karte1"
+_NUMBER_SUFFIX = re.compile(r"(\s+\S*\d\S*)+$")
+
+
+def normalize_name(name: str | None) -> str | None:
+    """
+    Reduce a counterparty or merchant name to a key for equality and prefix
+    matching: case-folded, punctuation collapsed to single spaces, and card
+    terminal noise stripped. Returns None if nothing is left.
+    """
+    if name is None:
+        return None
+
+    normalized = _LOCATION_SUFFIX.sub("", name.casefold())
+    normalized = _PUNCTUATION.sub(" ", normalized).strip()
+    normalized = _NUMBER_SUFFIX.sub("", normalized)
+
+    return normalized or None
@@ -0,0 +1,92 @@
+import math
+import time
+
+from api.core.config import settings
+from api.core.exceptions import GoCardlessRateLimitError
+
+from .redis import redis_client
+
+# Each bucket is a hash holding the tokens left until the provider's quota
+# resets, expiring together with that quota. A missing bucket means the quota
+# is unknown (or has reset) and requests pass until a response reports it again.
+
+# Take one token from every bucket, or none if any bucket is empty.
+# Returns 0 on success, otherwise the milliseconds until the longest reset.
+_ACQUIRE_SCRIPT = redis_client.register_script(
+    """
+    local wait = 0
+    for _, key in ipairs(KEYS) do
+        local tokens = redis.call('HGET', key, 'tokens')
+        if tokens and tonumber(tokens) <= 0 then
+            local ttl = redis.call('PTTL', key)
+            if ttl < 0 then
+                redis.call('DEL', key)
+            elseif ttl > wait then
+                wait = ttl
+            end
+        end
+    end
+
+    if wait > 0 then
+        return wait
+    end
+
+    for _, key in ipairs(KEYS) do
+        if redis.call('EXISTS', key) == 1 then
+            redis.call('HINCRBY', key, 'tokens', -1)
+        end
+    end
+    return 0
+    """
+)
+
+# Record the remaining quota reported by the provider. Within one window the
+# lowest report wins, since responses to concurrent requests arrive out of order.
+_UPDATE_SCRIPT = redis_client.register_script(
+    """
+    local tokens = tonumber(ARGV[1])
+    local current = redis.call('HGET', KEYS[1], 'tokens')
+    if current and tonumber(current) < tokens then
+        tokens = tonumber(current)
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tokens)
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    return tokens
+    """
+)
+
+
+def _bucket_key(scope: str) -> str:
+    return f"{settings.REDIS_PREFIX}gocardless:ratelimit:{scope}"
+
+
+def acquire(operation: str, scopes: list[str], max_wait: float | None = None) -> None:
+    """
+    Take a request slot from every scope, sleeping for at most ``max_wait``.
+
+    Raises GoCardlessRateLimitError when a quota only resets after that, so the
+    caller can reschedule instead of burning the request on a 429.
+    """
+    if max_wait is None:
+        max_wait = settings.GOCARDLESS_RATE_LIMIT_MAX_WAIT
+
+    keys = [_bucket_key(scope) for scope in scopes]
+    deadline = time.monotonic() + max_wait
+
+    while True:
+        wait = _ACQUIRE_SCRIPT(keys=keys) / 1000
+        if not wait:
+            return
+
+        if time.monotonic() + wait > deadline:
+            raise GoCardlessRateLimitError(operation, retry_after=wait)
+
+        time.sleep(wait)
+
+
+def update(scope: str, remaining: int, reset: float) -> None:
+    """Store the quota reported for ``scope``, resetting in ``reset`` seconds."""
+    _UPDATE_SCRIPT(
+        keys=[_bucket_key(scope)],
+        args=[remaining, max(math.ceil(reset * 1000), 1)],
+    )
@@ -0,0 +1,90 @@
+from typing import NamedTuple
+
+import numpy as np
+
+SECONDS_PER_DAY = 60 * 60 * 24
+
+MIN_OCCURRENCES = 3
+MIN_INTERVAL_DAYS = 5
+MAX_INTERVAL_DAYS = 400
+# Largest standard deviation relative to the mean still considered regular
+MAX_INTERVAL_VARIATION = 0.25
+MAX_AMOUNT_VARIATION = 0.2
+
+
+class SeriesStats(NamedTuple):
+    """Per-group statistics, one array element per recurring group."""
+
+    group: np.ndarray
+    transaction_count: np.ndarray
+    first_time: np.ndarray
+    last_time: np.ndarray
+    interval_days: np.ndarray
+    interval_deviation: np.ndarray
+    amount: np.ndarray
+    amount_deviation: np.ndarray
+
+
+def _mean_std(
+    groups: np.ndarray, values: np.ndarray, size: int
+) -> tuple[np.ndarray, np.ndarray]:
+    counts = np.bincount(groups, minlength=size)
+    sums = np.bincount(groups, weights=values, minlength=size)
+    squares = np.bincount(groups, weights=values * values, minlength=size)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = sums / counts
+        variance = squares / counts - mean * mean
+
+    return mean, np.sqrt(np.maximum(variance, 0))
+
+
+def detect_series(
+    groups: np.ndarray, times: np.ndarray, amounts: np.ndarray
+) -> SeriesStats:
+    """
+    Find the groups whose transactions recur at a regular interval with a
+    stable amount.
+
+    ``groups`` holds dense group codes (0 to n-1, every code present),
+    ``times`` the booking times as epoch seconds and ``amounts`` the amounts,
+    one element per transaction in any order. All statistics are computed
+    with array operations, without a Python loop over transactions or groups.
+    """
+    if not len(groups):
+        return SeriesStats(*(np.empty(0) for _ in SeriesStats._fields))
+
+    order = np.lexsort((times, groups))
+    groups, times, amounts = groups[order], times[order], amounts[order]
+    size = int(groups[-1]) + 1
+
+    # Consecutive transactions of the same group form one interval
+    same_group = groups[1:] == groups[:-1]
+    intervals = np.diff(times)[same_group] / SECONDS_PER_DAY
+    interval_mean, interval_std = _mean_std(groups[1:][same_group], intervals, size)
+    amount_mean, amount_std = _mean_std(groups, amounts, size)
+
+    starts = np.flatnonzero(np.concatenate(([True], ~same_group)))
+    ends = np.concatenate((starts[1:], [len(groups)])) - 1
+    counts = ends - starts + 1
+
+    with np.errstate(invalid="ignore"):
+        recurring = (
+            (counts >= MIN_OCCURRENCES)
+            & (interval_mean >= MIN_INTERVAL_DAYS)
+            & (interval_mean <= MAX_INTERVAL_DAYS)
+            & (interval_std <= MAX_INTERVAL_VARIATION * interval_mean)
+            & (amount_std <= MAX_AMOUNT_VARIATION * np.abs(amount_mean))
+        )
+
+    (index,) = np.nonzero(recurring)
+    return SeriesStats(
+        group=index,
+        transaction_count=counts[index],
+        first_time=times[starts[index]],
+        last_time=times[ends[index]],
+        interval_days=interval_mean[index],
+        interval_deviation=interval_std[index],
+        amount=amount_mean[index],
+        amount_deviation=amount_std[index],
+    )
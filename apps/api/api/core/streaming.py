@@ -0,0 +1,157 @@
+import codecs
+import json
+from collections.abc import Iterable, Iterator, Sequence
+from typing import Any
+
+WHITESPACE = " \t\n\r"
+NUMBER_CHARS = "0123456789+-.eE"
+
+
+class _Reader:
+    """Incrementally decoded text buffer over an iterable of byte chunks."""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._json = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def more(self) -> bool:
+        if self.eof:
+            return False
+
+        # Drop consumed text so the buffer only ever holds the current value
+        self.buf = self.buf[self.pos :]
+        self.pos = 0
+
+        for chunk in self._chunks:
+            text = self._decoder.decode(chunk)
+            if text:
+                self.buf += text
+                return True
+
+        self.buf += self._decoder.decode(b"", final=True)
+        self.eof = True
+        return False
+
+    def peek(self) -> str:
+        """Return the next non-whitespace character without consuming it."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.more():
+                raise ValueError("Unexpected end of JSON document")
+
+    def expect(self, chars: str) -> str:
+        char = self.peek()
+        if char not in chars:
+            raise ValueError(
+                f"Expected one of {chars!r} at offset {self.pos}, got {char!r}"
+            )
+        self.pos += 1
+        return char
+
+    def value(self) -> Any:
+        self.peek()
+        while True:
+            try:
+                value, end = self._json.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self.more():
+                    continue
+                raise
+
+            # A number followed only by number characters, such as "-0." or
+            # "1e+", may continue in the next chunk
+            if (
+                self.buf[self.pos] in "-0123456789"
+                and all(char in NUMBER_CHARS for char in self.buf[end:])
+                and self.more()
+            ):
+                continue
+
+            self.pos = end
+            return value
+
+    def skip(self) -> None:
+        """Consume the next value without materialising containers."""
+        if self.peek() not in "{[":
+            self.value()
+            return
+
+        depth = 0
+        in_string = False
+        escaped = False
+        while True:
+            while self.pos < len(self.buf):
+                char = self.buf[self.pos]
+                self.pos += 1
+
+                if in_string:
+                    if escaped:
+                        escaped = False
+                    elif char == "\\":
+                        escaped = True
+                    elif char == '"':
+                        in_string = False
+                elif char == '"':
+                    in_string = True
+                elif char in "{[":
+                    depth += 1
+                elif char in "}]":
+                    depth -= 1
+                    if depth == 0:
+                        return
+
+            if not self.more():
+                raise ValueError("Unexpected end of JSON document")
+
+
+def iter_json_array(chunks: Iterable[bytes], path: Sequence[str]) -> Iterator[Any]:
+    """
+    Yield the items of the array found under ``path`` in a JSON document.
+
+    Only one array item (plus whatever sibling value is being skipped) is held
+    in memory at a time. Yields nothing if the path does not exist or does not
+    hold an array, e.g. is null.
+    """
+    reader = _Reader(chunks)
+
+    reader.expect("{")
+    level = 0
+
+    while True:
+        if reader.peek() == "}":
+            return
+
+        key = reader.value()
+        reader.expect(":")
+
+        if key != path[level]:
+            reader.skip()
+            if reader.expect(",}") == "}":
+                return
+            continue
+
+        if level == len(path) - 1:
+            break
+
+        if reader.peek() != "{":
+            return
+        reader.expect("{")
+        level += 1
+
+    if reader.peek() != "[":
+        return
+    reader.expect("[")
+    if reader.peek() == "]":
+        return
+
+    while True:
+        yield reader.value()
+        if reader.expect(",]") == "]":
+            return
@@ -1,17 +1,361 @@
+import random
+import threading
+import time
+from typing import Any
+
+from prometheus_client import Gauge, Histogram
+from sqlalchemy import URL, Connection, Engine, Select, event, make_url, text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 from sqlmodel import Session, SQLModel, create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from api.core.config import settings
+from api.core.metrics import CallbackGauge
+from api.db.partitions import ensure_partitions, partition_window
+from api.db.queries import instrument_engine
+
+# Seconds a replica is behind the primary, zero while it has replayed all
+# received WAL
+REPLICA_LAG_QUERY = text(
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp()) END"
+)
+
+# Engines by name, for the pool gauge
+_engines: dict[str, Engine] = {}
+
+
+def _pool_stats() -> list[tuple[dict[str, str], float]]:
+    stats: list[tuple[dict[str, str], float]] = []
+    for name, db_engine in _engines.items():
+        pool = db_engine.pool
+        if not isinstance(pool, QueuePool):
+            continue
+
+        capacity = pool.size() + pool._max_overflow
+        stats.append(({"pool": name, "stat": "checked_out"}, pool.checkedout()))
+        stats.append(({"pool": name, "stat": "idle"}, pool.checkedin()))
+        stats.append(({"pool": name, "stat": "capacity"}, capacity))
+        stats.append(
+            ({"pool": name, "stat": "saturation"}, pool.checkedout() / capacity)
+        )
+    return stats
+
+
+DB_POOL = CallbackGauge(
+    "db_pool",
+    "Checked out and idle connections, capacity and saturation per engine pool.",
+    ["pool", "stat"],
+    _pool_stats,
+)
+DB_POOL_WAIT_SECONDS = Histogram(
+    "db_pool_wait_seconds",
+    "Time spent waiting to check out a connection from the pool.",
+    ["pool"],
+)
+DB_REPLICA_LAG_SECONDS = Gauge(
+    "db_replica_lag_seconds",
+    "Replication lag of each read replica when it was last checked.",
+    ["replica"],
+)
+DB_CONNECTION_LIFETIME_SECONDS = Histogram(
+    "db_connection_lifetime_seconds",
+    "Age of database connections when the pool closes them.",
+    ["pool"],
+    buckets=(1, 10, 60, 300, 900, 1800, 3600, 7200),
+)
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a connection."""
+
+    def _do_get(self) -> Any:
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_WAIT_SECONDS.labels(
+                pool=self._orig_logging_name or "default"
+            ).observe(time.perf_counter() - start)
+
+
+class InstrumentedAsyncQueuePool(InstrumentedQueuePool, AsyncAdaptedQueuePool):
+    """InstrumentedQueuePool for asyncio engines."""
+
+
+def _pool_options(name: str, poolclass: type[QueuePool]) -> dict[str, Any]:
+    return {
+        "poolclass": poolclass,
+        "pool_size": settings.DATABASE_POOL_SIZE,
+        "max_overflow": settings.DATABASE_MAX_OVERFLOW,
+        "pool_timeout": settings.DATABASE_POOL_TIMEOUT,
+        "pool_recycle": settings.DATABASE_POOL_RECYCLE,
+        "pool_pre_ping": True,
+        "pool_logging_name": name,
+    }
+
+
+def _register_engine(db_engine: Engine, name: str) -> None:
+    @event.listens_for(db_engine, "connect")
+    def record_connect(dbapi_connection: Any, connection_record: Any) -> None:
+        connection_record.info["connected_at"] = time.monotonic()
+
+    @event.listens_for(db_engine, "close")
+    def record_close(dbapi_connection: Any, connection_record: Any) -> None:
+        connected_at = connection_record.info.pop("connected_at", None)
+        if connected_at is not None:
+            DB_CONNECTION_LIFETIME_SECONDS.labels(pool=name).observe(
+                time.monotonic() - connected_at
+            )
+
+    instrument_engine(db_engine)
+    _engines[name] = db_engine
+
+
+def create_db_engine(
+    url: str | None = None,
+    name: str = "primary",
+    statement_timeout: int | None = None,
+) -> Engine:
+    """
+    Create an engine configured by the DATABASE_* settings.
+
+    Postgres engines get a bounded, pre-pinged and recycled pool whose
+    telemetry is exported under ``name``, and, unless ``statement_timeout``
+    is None, a server side statement timeout in milliseconds.
+    """
+    url = url or settings.DATABASE_URL
+    options: dict[str, Any] = {"echo": settings.DATABASE_ECHO}
+
+    if make_url(url).get_backend_name() == "postgresql":
+        options.update(_pool_options(name, InstrumentedQueuePool))
+        if statement_timeout is not None:
+            options["connect_args"] = {
+                "options": f"-c statement_timeout={statement_timeout}"
+            }
+
+    db_engine = create_engine(url, **options)
+    _register_engine(db_engine, name)
+    return db_engine
+
+
+def async_database_url(url: str) -> URL:
+    """Swap the driver of a sync database URL for its asyncio counterpart."""
+    async_url = make_url(url)
+    backend = async_url.get_backend_name()
+    if backend == "postgresql":
+        return async_url.set(drivername="postgresql+asyncpg")
+    if backend == "sqlite":
+        return async_url.set(drivername="sqlite+aiosqlite")
+    return async_url
+
+
+def create_async_db_engine(
+    url: str | URL | None = None,
+    name: str = "primary_async",
+    statement_timeout: int | None = None,
+) -> AsyncEngine:
+    """
+    Create an asyncio engine for the request path, configured like
+    create_db_engine.
+
+    ``url`` defaults to ASYNC_DATABASE_URL, or DATABASE_URL with its driver
+    swapped by async_database_url.
+    """
+    url = url or settings.ASYNC_DATABASE_URL
+    async_url = make_url(url) if url else async_database_url(settings.DATABASE_URL)
+    options: dict[str, Any] = {"echo": settings.DATABASE_ECHO}
+
+    if async_url.get_backend_name() == "postgresql":
+        options.update(_pool_options(name, InstrumentedAsyncQueuePool))
+        if statement_timeout is not None:
+            # asyncpg takes server settings instead of a libpq options string
+            options["connect_args"] = {
+                "server_settings": {"statement_timeout": str(statement_timeout)}
+            }
+
+    db_engine = create_async_engine(async_url, **options)
+    _register_engine(db_engine.sync_engine, name)
+    return db_engine
+
+
+class Replica:
+    """A read replica and its most recently measured replication lag."""
+
+    def __init__(self, url: str, name: str):
+        self.name = name
+        self.engine = create_db_engine(
+            url, name, statement_timeout=settings.DATABASE_STATEMENT_TIMEOUT
+        )
+        self.async_engine = create_async_db_engine(
+            async_database_url(url),
+            f"{name}_async",
+            statement_timeout=settings.DATABASE_STATEMENT_TIMEOUT,
+        )
+
+        self._available = False
+        self._checked_at = float("-inf")
 
-# Create database engine
-engine = create_engine(settings.DATABASE_URL, echo=True)
+    def check(self) -> None:
+        """Measure the replication lag, blocking until the replica answers."""
+        try:
+            with self.engine.connect() as connection:
+                lag = float(connection.execute(REPLICA_LAG_QUERY).scalar() or 0)
+            DB_REPLICA_LAG_SECONDS.labels(replica=self.name).set(lag)
+            self._available = lag <= settings.DATABASE_REPLICA_MAX_LAG
+        except SQLAlchemyError:
+            self._available = False
+        self._checked_at = time.monotonic()
+
+    def is_available(self) -> bool:
+        """
+        Whether the replica was reachable and within DATABASE_REPLICA_MAX_LAG
+        when last checked, without touching the database. Results older than
+        two check intervals count as unavailable, in case checks stalled.
+        """
+        age = time.monotonic() - self._checked_at
+        return (
+            self._available and age < 2 * settings.DATABASE_REPLICA_LAG_CHECK_INTERVAL
+        )
+
+
+class ReplicaMonitor(threading.Thread):
+    """Daemon thread checking replicas every DATABASE_REPLICA_LAG_CHECK_INTERVAL."""
+
+    def __init__(self, monitored: list[Replica]):
+        super().__init__(name="replica-monitor", daemon=True)
+        self.monitored = monitored
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopped.is_set():
+            for replica in self.monitored:
+                replica.check()
+            self.stopped.wait(settings.DATABASE_REPLICA_LAG_CHECK_INTERVAL)
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.join()
+
+
+def pick_replica() -> Replica | None:
+    """Pick one of the available replicas at random, None if there is none."""
+    available = [replica for replica in replicas if replica.is_available()]
+    return random.choice(available) if available else None
+
+
+class RoutingSession(Session):
+    """
+    Session that sends reads to a replica and everything else to its bind.
+
+    Once the session has written or locked rows, or run a statement it cannot
+    classify, it stays on the primary so it reads its own writes. Without an
+    available replica all statements go to the primary.
+    """
+
+    # Route to the asyncio engines of the replicas
+    _asyncio = False
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self._primary_only = False
+
+    def get_bind(
+        self, mapper: Any = None, *, clause: Any = None, **kwargs: Any
+    ) -> Engine | Connection:
+        if (
+            not self._primary_only
+            and not self._flushing
+            and isinstance(clause, Select)
+            and clause._for_update_arg is None
+        ):
+            replica = pick_replica()
+            if replica is not None:
+                if self._asyncio:
+                    return replica.async_engine.sync_engine
+                return replica.engine
+        else:
+            self._primary_only = True
+
+        return super().get_bind(mapper, clause=clause, **kwargs)
+
+
+class AsyncRoutingSession(RoutingSession):
+    """RoutingSession behind an AsyncSession."""
+
+    _asyncio = True
+
+
+# Create database engines, the async one serves FastAPI requests and the sync
+# one Celery tasks
+engine = create_db_engine(statement_timeout=settings.DATABASE_TASK_STATEMENT_TIMEOUT)
+async_engine = create_async_db_engine(
+    statement_timeout=settings.DATABASE_STATEMENT_TIMEOUT
+)
+
+# Read replicas of this process, only request processes create them, see
+# start_replicas
+replicas: list[Replica] = []
+_monitors: list[ReplicaMonitor] = []
+
+
+def start_replicas() -> None:
+    """
+    Create the DATABASE_REPLICA_URLS engines and start checking their lag in
+    the background, so routing reads never waits on a lag query.
+
+    Called once by each API process. Elsewhere, e.g. in Celery workers, there
+    are no replicas and RoutingSession sends everything to its bind.
+    """
+    if _monitors or not settings.DATABASE_REPLICA_URLS:
+        return
+
+    replicas.extend(
+        Replica(url, f"replica_{index}")
+        for index, url in enumerate(settings.DATABASE_REPLICA_URLS)
+    )
+    monitor = ReplicaMonitor(replicas)
+    monitor.start()
+    _monitors.append(monitor)
+
+
+def stop_replicas() -> None:
+    """Stop the lag checks started by start_replicas and route to the primary."""
+    while _monitors:
+        _monitors.pop().stop()
+    replicas.clear()
+
+
+def dispose_engines() -> None:
+    """
+    Drop the pooled connections inherited from a parent process.
+
+    Forked processes must call this before using the database, the parent
+    keeps using the sockets it opened.
+    """
+    for db_engine in _engines.values():
+        db_engine.dispose(close=False)
 
 
 def create_db_and_tables():
     """Create database and tables"""
     SQLModel.metadata.create_all(engine)
 
+    months = partition_window()
+    ensure_partitions(engine, months[0], months[-1])
+
 
 def get_db():
     """Dependency to get database session"""
-    with Session(engine) as session:
+    with RoutingSession(engine) as session:
+        yield session
+
+
+async def get_async_db():
+    """Dependency to get an async database session"""
+    async with AsyncSession(
+        async_engine, sync_session_class=AsyncRoutingSession, expire_on_commit=False
+    ) as session:
         yield session
@@ -0,0 +1,192 @@
+import re
+import threading
+from datetime import UTC, date, datetime, timedelta
+
+from sqlalchemy import Connection, Engine, text
+
+from api.core.config import settings
+
+# Monthly range partitions of the transaction table by booking_time, bookings
+# outside of them land in the default partition
+PARTITIONED_TABLE = "transaction"
+DEFAULT_PARTITION = f"{PARTITIONED_TABLE}_default"
+PARTITION_NAME = re.compile(rf"{PARTITIONED_TABLE}_(\d{{4}}_\d{{2}}|default)")
+
+# Serializes partition creation across processes, any constant shared by them
+PARTITION_LOCK_ID = 0x6B6F7275
+
+_known_partitions: set[str] = set()
+_known_lock = threading.Lock()
+
+
+def month_start(value: date) -> date:
+    return date(value.year, value.month, 1)
+
+
+def next_month(month: date) -> date:
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"{PARTITIONED_TABLE}_{month:%Y_%m}"
+
+
+def is_partition(table_name: str | None) -> bool:
+    """Whether ``table_name`` is a partition managed here, not a model table."""
+    return table_name is not None and PARTITION_NAME.fullmatch(table_name) is not None
+
+
+def partition_months(start: date, end: date) -> list[date]:
+    """First days of the months from ``start`` through ``end``, inclusive."""
+    months = []
+    month = month_start(start)
+    while month <= end:
+        months.append(month)
+        month = next_month(month)
+    return months
+
+
+def previous_month(month: date) -> date:
+    return date(month.year - (month.month == 1), (month.month - 2) % 12 + 1, 1)
+
+
+def partition_window(today: date | None = None) -> list[date]:
+    """
+    The months from TRANSACTION_PARTITIONS_BEHIND before the current one
+    through TRANSACTION_PARTITIONS_AHEAD after it.
+    """
+    month = month_start(today or datetime.now(UTC).date())
+    for _ in range(settings.TRANSACTION_PARTITIONS_BEHIND):
+        month = previous_month(month)
+
+    months = [month]
+    for _ in range(
+        settings.TRANSACTION_PARTITIONS_BEHIND + settings.TRANSACTION_PARTITIONS_AHEAD
+    ):
+        months.append(next_month(months[-1]))
+    return months
+
+
+def partition_ddl(month: date) -> str:
+    return (
+        f'CREATE TABLE IF NOT EXISTS "{partition_name(month)}" '
+        f'PARTITION OF "{PARTITIONED_TABLE}" '
+        f"FOR VALUES FROM ('{month}') TO ('{next_month(month)}')"
+    )
+
+
+def default_partition_ddl() -> str:
+    return (
+        f'CREATE TABLE IF NOT EXISTS "{DEFAULT_PARTITION}" '
+        f'PARTITION OF "{PARTITIONED_TABLE}" DEFAULT'
+    )
+
+
+def is_partitioned(connection: Connection) -> bool:
+    return (
+        connection.execute(
+            text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:table)"),
+            {"table": f'"{PARTITIONED_TABLE}"'},
+        ).scalar()
+        == "p"
+    )
+
+
+def ensure_partitions(db_engine: Engine, start: date, end: date) -> int:
+    """
+    Create the missing partitions for bookings from ``start`` through ``end``,
+    and the default partition.
+
+    Partitions known to exist are remembered per process, so calls covering
+    only existing months issue no statements. Creation runs in its own
+    transaction under an advisory lock and takes exclusive locks on the table,
+    so it belongs in scheduled jobs, not imports. Returns the number of
+    monthly partitions created, always 0 on databases other than Postgres.
+    """
+    if db_engine.dialect.name != "postgresql":
+        return 0
+
+    # Aware booking times are stored in the session time zone, a day of margin
+    # covers whichever month they land in
+    months = [
+        month
+        for month in partition_months(
+            start - timedelta(days=1), end + timedelta(days=1)
+        )
+        if partition_name(month) not in _known_partitions
+    ]
+    if not months:
+        return 0
+
+    with _known_lock:
+        with db_engine.begin() as connection:
+            created = create_partitions(connection, months)
+
+        _known_partitions.update(partition_name(month) for month in months)
+
+    return len(created)
+
+
+def create_partitions(connection: Connection, months: list[date]) -> list[date]:
+    """
+    Create the default partition and those of ``months`` on ``connection``,
+    unless they exist, under the advisory lock of ensure_partitions. Bookings
+    of the months in the default partition are moved into theirs.
+
+    Returns the months whose partitions were created.
+    """
+    connection.execute(
+        text("SELECT pg_advisory_xact_lock(:lock_id)"),
+        {"lock_id": PARTITION_LOCK_ID},
+    )
+    existing = set(
+        connection.execute(
+            text(
+                "SELECT relname FROM pg_inherits "
+                "JOIN pg_class ON pg_class.oid = inhrelid "
+                "WHERE inhparent = to_regclass(:table) AND relkind = 'r'"
+            ),
+            {"table": f'"{PARTITIONED_TABLE}"'},
+        ).scalars()
+    )
+    if DEFAULT_PARTITION not in existing:
+        connection.execute(text(default_partition_ddl()))
+
+    missing = [month for month in months if partition_name(month) not in existing]
+    for month in missing:
+        _create_partition(connection, month)
+
+    return missing
+
+
+def _create_partition(connection: Connection, month: date) -> None:
+    """
+    Create the partition of ``month``. Postgres rejects it while the default
+    partition holds bookings of that month, those are moved into it as they
+    are.
+    """
+    bounds = {"start": month, "end": next_month(month)}
+    in_default = (
+        f'FROM "{DEFAULT_PARTITION}" '
+        "WHERE booking_time >= :start AND booking_time < :end"
+    )
+
+    if not connection.execute(
+        text(f"SELECT EXISTS (SELECT 1 {in_default})"), bounds
+    ).scalar():
+        connection.execute(text(partition_ddl(month)))
+        return
+
+    connection.execute(
+        text(f'CREATE TEMPORARY TABLE moved (LIKE "{PARTITIONED_TABLE}")')
+    )
+    connection.execute(
+        text(
+            f"WITH deleted AS (DELETE {in_default} RETURNING *) "
+            "INSERT INTO moved SELECT * FROM deleted"
+        ),
+        bounds,
+    )
+    connection.execute(text(partition_ddl(month)))
+    connection.execute(text(f'INSERT INTO "{PARTITIONED_TABLE}" SELECT * FROM moved'))
+    connection.execute(text("DROP TABLE moved"))
@@ -0,0 +1,148 @@
+import heapq
+import logging
+import time
+from contextvars import ContextVar, Token
+from typing import Any
+
+from prometheus_client import Counter, Histogram
+from sqlalchemy import Engine, event
+
+from api.core.config import settings
+from api.core.exceptions import QueryBudgetExceededError
+
+logger = logging.getLogger(__name__)
+
+# Slowest statements kept per scope for the budget report
+SLOWEST_STATEMENTS = 5
+# Statements are cut to this many characters in reports
+STATEMENT_PREVIEW_LENGTH = 200
+
+SCOPE_STATEMENTS = Histogram(
+    "db_scope_statements",
+    "Statements issued per request or task.",
+    ["kind", "name"],
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000),
+)
+SCOPE_SECONDS = Histogram(
+    "db_scope_seconds",
+    "Time spent executing statements per request or task.",
+    ["kind", "name"],
+)
+BUDGET_EXCEEDED = Counter(
+    "db_query_budget_exceeded",
+    "Requests and tasks that issued more statements than their budget.",
+    ["kind", "name"],
+)
+
+_current_scope: ContextVar["QueryScope | None"] = ContextVar(
+    "query_scope", default=None
+)
+
+
+class QueryScope:
+    """
+    Statement count, total execution time and slowest statements of one
+    request or task.
+
+    Statements on instrumented engines are attributed to the innermost open
+    scope of the current context. A scope with a ``budget`` logs its slowest
+    statements when it closes over budget, or with
+    DATABASE_QUERY_BUDGET_STRICT fails the statement that exceeds it.
+    """
+
+    def __init__(self, kind: str, name: str, budget: int | None = None):
+        self.kind = kind
+        self.name = name
+        self.budget = budget
+        self.statements = 0
+        self.seconds = 0.0
+        # Min-heap of (seconds, statement), the fastest kept one on top
+        self.slowest: list[tuple[float, str]] = []
+        self._token: Token[QueryScope | None] | None = None
+
+    def __enter__(self) -> "QueryScope":
+        self._token = _current_scope.set(self)
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self._token is not None:
+            _current_scope.reset(self._token)
+            self._token = None
+
+        SCOPE_STATEMENTS.labels(kind=self.kind, name=self.name).observe(self.statements)
+        SCOPE_SECONDS.labels(kind=self.kind, name=self.name).observe(self.seconds)
+
+        if self.over_budget:
+            BUDGET_EXCEEDED.labels(kind=self.kind, name=self.name).inc()
+            logger.warning(
+                "%s %s issued %d statements (budget %d) in %.3fs, slowest:\n%s",
+                self.kind,
+                self.name,
+                self.statements,
+                self.budget,
+                self.seconds,
+                "\n".join(
+                    f"  {seconds:.3f}s {statement}"
+                    for seconds, statement in sorted(self.slowest, reverse=True)
+                ),
+            )
+
+    @property
+    def over_budget(self) -> bool:
+        return self.budget is not None and self.statements > self.budget
+
+    def _before_statement(self) -> None:
+        self.statements += 1
+        if self.over_budget and settings.DATABASE_QUERY_BUDGET_STRICT:
+            assert self.budget is not None
+            raise QueryBudgetExceededError(f"{self.kind} {self.name}", self.budget)
+
+    def _after_statement(self, statement: str, seconds: float) -> None:
+        self.seconds += seconds
+        if len(self.slowest) == SLOWEST_STATEMENTS and seconds <= self.slowest[0][0]:
+            return
+
+        entry = (seconds, " ".join(statement.split())[:STATEMENT_PREVIEW_LENGTH])
+        if len(self.slowest) < SLOWEST_STATEMENTS:
+            heapq.heappush(self.slowest, entry)
+        else:
+            heapq.heapreplace(self.slowest, entry)
+
+
+def current_scope() -> QueryScope | None:
+    return _current_scope.get()
+
+
+def instrument_engine(db_engine: Engine) -> None:
+    """Attribute the statements of ``db_engine`` to the current QueryScope."""
+
+    @event.listens_for(db_engine, "before_cursor_execute")
+    def start_statement(
+        connection: Any,
+        cursor: Any,
+        statement: str,
+        parameters: Any,
+        context: Any,
+        executemany: bool,
+    ) -> None:
+        scope = _current_scope.get()
+        if scope is not None:
+            scope._before_statement()
+            connection.info["query_started_at"] = time.perf_counter()
+
+    @event.listens_for(db_engine, "after_cursor_execute")
+    def finish_statement(
+        connection: Any,
+        cursor: Any,
+        statement: str,
+        parameters: Any,
+        context: Any,
+        executemany: bool,
+    ) -> None:
+        scope = _current_scope.get()
+        started_at = connection.info.pop("query_started_at", None)
+        if scope is not None and started_at is not None:
+            scope._after_statement(statement, time.perf_counter() - started_at)
@@ -1,23 +1,48 @@
-from typing import Any
+import csv
+import io
+from collections.abc import Sequence
+from enum import Enum
+from typing import Any, NamedTuple
 
-from sqlalchemy import tuple_
-from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy import (
+    Column,
+    MetaData,
+    Table,
+    exists,
+    func,
+    literal_column,
+    null,
+    select,
+    tuple_,
+)
+from sqlalchemy.dialects.postgresql import Insert, insert
+from sqlalchemy.sql.dml import ReturningInsert
 from sqlmodel import Session
 
+# Postgres rejects statements with more bind parameters than this
+MAX_BIND_PARAMETERS = 65535
+DEFAULT_BATCH_SIZE = 1000
+COPY_CHUNK_SIZE = 10000
 
-def upsert_db(
-    values: list[Any],
-    session: Session,
+
+class UpsertResult(NamedTuple):
+    inserted: int
+    updated: int
+    unchanged: int
+    # IDs of inserted and updated rows, when requested
+    changed_ids: tuple[Any, ...] = ()
+    # Values of the requested columns before the update, one tuple per updated row
+    previous: tuple[tuple[Any, ...], ...] = ()
+
+
+def _on_conflict_update(
+    insert_stmt: Insert,
     model: Any,
     update_whitelist: list[str],
     index_elements: list[Any],
-    update_override: dict[str, Any] | None = None,
-) -> None:
-    if update_override is None:
-        update_override = {}
-
-    insert_stmt = insert(model).values(values)
-
+    update_override: dict[str, Any],
+    return_previous: Sequence[str] = (),
+) -> ReturningInsert[Any]:
     update_columns = {
         **{col: getattr(insert_stmt.excluded, col) for col in update_whitelist},
         **update_override,
@@ -28,11 +53,201 @@ def upsert_db(
         *[getattr(insert_stmt.excluded, col) for col in update_whitelist]
     )
 
-    insert_stmt = insert_stmt.on_conflict_do_update(
+    # Subqueries see the table as it was before the statement, so the stored
+    # row reads its previous values. RETURNING does not correlate, so the outer
+    # row is referenced literally
+    table = model.__table__
+    prior = table.alias("prior")
+    same_row = [
+        prior.c[column.name] == literal_column(f'"{table.name}"."{column.name}"')
+        for column in table.primary_key
+    ]
+
+    if table.dialect_options["postgresql"]["partition_by"]:
+        # Partitioned tables hide xmax, but inserted rows have no prior row
+        inserted = ~exists().where(*same_row)
+    else:
+        inserted = literal_column("xmax = 0")
+
+    # Only inserted and updated rows are returned, xmax is 0 for inserts
+    return insert_stmt.on_conflict_do_update(
         index_elements=index_elements,
         set_=update_columns,
         where=where_tuple_existing.is_distinct_from(where_tuple_new),
+    ).returning(
+        inserted.label("inserted"),
+        # Not the primary key, partitioned tables extend it by their partition key
+        table.c.id.label("changed_id"),
+        *[
+            select(prior.c[name])
+            .where(*same_row)
+            .scalar_subquery()
+            .label(f"previous_{name}")
+            for name in return_previous
+        ],
     )
 
-    session.execute(insert_stmt)
+
+def upsert_db(
+    values: list[Any],
+    session: Session,
+    model: Any,
+    update_whitelist: list[str],
+    index_elements: list[Any],
+    update_override: dict[str, Any] | None = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    return_ids: bool = False,
+    return_previous: Sequence[str] = (),
+) -> UpsertResult:
+    """
+    Insert or update ``values`` in statements of at most ``batch_size`` rows.
+
+    Batches are shrunk to stay under the bind parameter limit and all run in
+    one transaction, committed once every batch succeeded. Rows whose
+    whitelisted columns are unchanged are left untouched, ``return_ids``
+    collects the IDs of all other rows and ``return_previous`` the values the
+    given columns of updated rows had before.
+    """
+    if update_override is None:
+        update_override = {}
+
+    if not values:
+        return UpsertResult(inserted=0, updated=0, unchanged=0)
+
+    parameters_per_row = len(values[0]) + len(update_override)
+    batch_size = max(1, min(batch_size, MAX_BIND_PARAMETERS // parameters_per_row))
+
+    inserted = 0
+    updated = 0
+    changed_ids: list[Any] = []
+    previous: list[tuple[Any, ...]] = []
+
+    for start in range(0, len(values), batch_size):
+        upsert_stmt = _on_conflict_update(
+            insert(model).values(values[start : start + batch_size]),
+            model,
+            update_whitelist,
+            index_elements,
+            update_override,
+            return_previous,
+        )
+
+        rows = session.execute(upsert_stmt).all()
+        batch_inserted = sum(1 for row in rows if row.inserted)
+        inserted += batch_inserted
+        updated += len(rows) - batch_inserted
+
+        if return_ids:
+            changed_ids.extend(row.changed_id for row in rows)
+        if return_previous:
+            previous.extend(tuple(row[2:]) for row in rows if not row.inserted)
+
     session.commit()
+
+    return UpsertResult(
+        inserted=inserted,
+        updated=updated,
+        unchanged=len(values) - inserted - updated,
+        changed_ids=tuple(changed_ids),
+        previous=tuple(previous),
+    )
+
+
+def copy_upsert_db(
+    values: list[Any],
+    session: Session,
+    model: Any,
+    update_whitelist: list[str],
+    index_elements: list[Any],
+    update_override: dict[str, Any] | None = None,
+    return_ids: bool = False,
+    return_previous: Sequence[str] = (),
+) -> UpsertResult:
+    """
+    Bulk variant of upsert_db for large loads, Postgres only.
+
+    Rows are streamed with COPY into a temporary staging table and merged with
+    a single ``INSERT ... SELECT ... ON CONFLICT`` using the same change
+    detection as upsert_db.
+    """
+    if update_override is None:
+        update_override = {}
+
+    if not values:
+        return UpsertResult(inserted=0, updated=0, unchanged=0)
+
+    table = model.__table__
+    columns = [column.name for column in table.columns if column.name in values[0]]
+
+    staging = Table(
+        f"{table.name}_staging",
+        MetaData(),
+        *[Column(name, table.c[name].type) for name in columns],
+        prefixes=["TEMPORARY"],
+        postgresql_on_commit="DROP",
+    )
+
+    connection = session.connection()
+    staging.create(connection)
+
+    cursor = connection.connection.dbapi_connection.cursor()  # type: ignore[union-attr]
+    copy_sql = (
+        f"COPY {staging.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+    )
+
+    try:
+        for start in range(0, len(values), COPY_CHUNK_SIZE):
+            buffer = io.StringIO()
+            writer = csv.writer(buffer, quoting=csv.QUOTE_NOTNULL)
+            for row in values[start : start + COPY_CHUNK_SIZE]:
+                writer.writerow(_copy_value(row[name]) for name in columns)
+            buffer.seek(0)
+
+            if hasattr(cursor, "copy_expert"):  # psycopg2
+                cursor.copy_expert(copy_sql, buffer)
+            else:  # psycopg 3
+                with cursor.copy(copy_sql) as copy:
+                    copy.write(buffer.getvalue())
+    finally:
+        cursor.close()
+
+    merge_stmt = _on_conflict_update(
+        insert(model).from_select(columns, select(*staging.c)),
+        model,
+        update_whitelist,
+        index_elements,
+        update_override,
+        return_previous,
+    ).cte("merged")
+
+    # Aggregates of one query consume the rows in the same order, so the
+    # previous values of a row share their position in each array
+    inserted, changed, changed_ids, *previous = session.execute(
+        select(
+            func.count().filter(merge_stmt.c.inserted),
+            func.count(),
+            func.array_agg(merge_stmt.c.changed_id) if return_ids else null(),
+            *[
+                func.array_agg(merge_stmt.c[f"previous_{name}"]).filter(
+                    ~merge_stmt.c.inserted
+                )
+                for name in return_previous
+            ],
+        ).select_from(merge_stmt)
+    ).one()
+
+    session.commit()
+
+    return UpsertResult(
+        inserted=inserted,
+        updated=changed - inserted,
+        unchanged=len(values) - changed,
+        changed_ids=tuple(changed_ids or ()),
+        previous=tuple(zip(*(column or () for column in previous), strict=True)),
+    )
+
+
+def _copy_value(value: Any) -> Any:
+    if isinstance(value, Enum):
+        return value.value
+    return value
@@ -2,18 +2,19 @@ from typing import Annotated
 
 import requests
 from fastapi import Cookie, Depends, Header, HTTPException, status
-from sqlmodel import Session, select
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from api.core.config import settings
 from api.core.redis import is_token_blacklisted
 from api.core.security import decode_jwt
-from api.db.database import get_db
+from api.db.database import get_async_db
 from api.models.user import User
 
 
 async def get_user(
     access_token: Annotated[str, Cookie()],
-    db: Annotated[Session, Depends(get_db)],
+    db: Annotated[AsyncSession, Depends(get_async_db)],
 ) -> User:
     payload = decode_jwt(access_token)
 
@@ -38,7 +39,7 @@ async def get_user(
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    user = db.exec(select(User).where(User.id == payload.sub)).one_or_none()
+    user = (await db.exec(select(User).where(User.id == payload.sub))).one_or_none()
 
     if user is None:
         raise HTTPException(
@@ -1,5 +1,14 @@
-from fastapi import FastAPI
+import secrets
+from contextlib import asynccontextmanager
+from typing import Annotated
+
+from fastapi import FastAPI, Header, HTTPException, Request, Response, status
 from fastapi.routing import APIRoute
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+from .core.config import settings
+from .db.database import start_replicas, stop_replicas
+from .db.queries import QueryScope
 
 # Import our routers
 from .routers import items, users
@@ -14,6 +23,14 @@ def custom_generate_unique_id(route: APIRoute) -> str:
     return name_parts[0] + "".join(part.capitalize() for part in name_parts[1:])
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Route reads to the read replicas while the app is running"""
+    start_replicas()
+    yield
+    stop_replicas()
+
+
 # Create the FastAPI app
 app = FastAPI(
     title="SpaceTalk API",
@@ -21,8 +38,25 @@ app = FastAPI(
     version="0.1.0",
     generate_unique_id_function=custom_generate_unique_id,
     root_path="/api",  # This means all routes will be prefixed with /api
+    lifespan=lifespan,
 )
 
+
+@app.middleware("http")
+async def query_scope(request: Request, call_next):
+    """Attribute the statements of each request to its route"""
+    with QueryScope(
+        "request", request.url.path, settings.DATABASE_REQUEST_QUERY_BUDGET
+    ) as scope:
+        response = await call_next(request)
+
+        # Known once routed, the template keeps the label cardinality bounded
+        route = request.scope.get("route")
+        scope.name = route.path if isinstance(route, APIRoute) else "unmatched"
+
+    return response
+
+
 # Include routers
 app.include_router(users.router)
 app.include_router(items.router)
@@ -43,3 +77,14 @@ async def root():
 async def health_check():
     """Health check endpoint for monitoring"""
     return {"status": "healthy"}
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics(authorization: Annotated[str | None, Header()] = None):
+    """Prometheus metrics for this process, for scrapers with the METRICS_TOKEN"""
+    if not settings.METRICS_TOKEN or not secrets.compare_digest(
+        authorization or "", f"Bearer {settings.METRICS_TOKEN}"
+    ):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
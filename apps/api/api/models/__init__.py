@@ -2,9 +2,18 @@ from .account import Account
 from .connection import Connection
 from .counterparty import Counterparty
 from .merchant import Merchant
+from .recurring_series import RecurringSeries
 from .transaction import Transaction, TransactionReadRelations
 from .user import User
 
 TransactionReadRelations.model_rebuild()
 
-__all__ = ["Account", "Connection", "Counterparty", "Merchant", "Transaction", "User"]
+__all__ = [
+    "Account",
+    "Connection",
+    "Counterparty",
+    "Merchant",
+    "RecurringSeries",
+    "Transaction",
+    "User",
+]
@@ -1,7 +1,8 @@
+from datetime import date
 from typing import TYPE_CHECKING
 
 from nanoid import generate
-from sqlmodel import Field, Relationship, SQLModel
+from sqlmodel import Field, Index, Relationship, SQLModel
 
 from api.models.enums.account import AccountType, ISOAccountType, UsageType
 
@@ -36,6 +37,13 @@ class AccountBase(SQLModel):
 class Account(AccountBase, BaseModel, table=True):
     id: str = Field(default_factory=generate, primary_key=True)
 
+    # Owner of the connection, denormalized so account linking can stay
+    # within one user's accounts
+    user_id: str | None = Field(default=None, foreign_key="user.id")
+
+    # Latest booking date imported, incremental syncs resume from here
+    transactions_synced_until: date | None = None
+
     connection: "Connection" = Relationship(back_populates="accounts")
     transactions: list["Transaction"] = Relationship(
         back_populates="account",
@@ -46,6 +54,11 @@ class Account(AccountBase, BaseModel, table=True):
         sa_relationship_kwargs={"foreign_keys": "[Transaction.opposing_account_id]"},
     )
 
+    __table_args__ = (
+        Index("ix_account_user_id_iban", "user_id", "iban"),
+        Index("ix_account_user_id_bban", "user_id", "bban"),
+    )
+
 
 class AccountCreate(AccountBase):
     pass
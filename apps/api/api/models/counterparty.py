@@ -1,7 +1,10 @@
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Any
 
 from nanoid import generate
-from sqlmodel import Field, Relationship, SQLModel
+from sqlalchemy import event
+from sqlmodel import Field, Index, Relationship, SQLModel
+
+from api.core.normalize import normalize_name
 
 from .base import BaseModel
 
@@ -20,11 +23,29 @@ class CounterpartyBase(SQLModel):
 
 class Counterparty(CounterpartyBase, BaseModel, table=True):
     id: str = Field(default_factory=generate, primary_key=True)
+    # normalize_name(name), kept in sync on flush
+    name_normalized: str | None = None
     creator: "User" = Relationship(back_populates="created_counterparties")
     transactions: list["Transaction"] = Relationship(
         back_populates="opposing_counterparty"
     )
 
+    __table_args__ = (
+        Index("ix_counterparty_creator_id_iban", "creator_id", "iban"),
+        Index("ix_counterparty_creator_id_bban", "creator_id", "bban"),
+        Index(
+            "ix_counterparty_creator_id_name_normalized",
+            "creator_id",
+            "name_normalized",
+        ),
+    )
+
+
+@event.listens_for(Counterparty, "before_insert")
+@event.listens_for(Counterparty, "before_update")
+def _normalize_name(mapper: Any, connection: Any, counterparty: Counterparty) -> None:
+    counterparty.name_normalized = normalize_name(counterparty.name)
+
 
 class CounterpartyCreate(CounterpartyBase):
     pass
@@ -1,8 +1,11 @@
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Any
 
 from nanoid import generate
+from sqlalchemy import event
 from sqlmodel import Field, Relationship, SQLModel
 
+from api.core.normalize import normalize_name
+
 from .base import BaseModel
 
 if TYPE_CHECKING:
@@ -19,9 +22,17 @@ class MerchantBase(SQLModel):
 
 class Merchant(MerchantBase, BaseModel, table=True):
     id: str = Field(default_factory=generate, primary_key=True)
+    # normalize_name(match_prefix), kept in sync on flush
+    match_prefix_normalized: str | None = None
     transactions: list["Transaction"] = Relationship(back_populates="opposing_merchant")
 
 
+@event.listens_for(Merchant, "before_insert")
+@event.listens_for(Merchant, "before_update")
+def _normalize_match_prefix(mapper: Any, connection: Any, merchant: Merchant) -> None:
+    merchant.match_prefix_normalized = normalize_name(merchant.match_prefix)
+
+
 class MerchantCreate(MerchantBase):
     pass
 
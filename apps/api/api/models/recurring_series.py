@@ -0,0 +1,44 @@
+from datetime import datetime
+
+from nanoid import generate
+from sqlmodel import Field, Index, SQLModel, text
+
+from .base import BaseModel
+
+
+class RecurringSeriesBase(SQLModel):
+    account_id: str = Field(foreign_key="account.id", index=True)
+    opposing_merchant_id: str | None = Field(default=None, foreign_key="merchant.id")
+    opposing_counterparty_id: str | None = Field(
+        default=None, foreign_key="counterparty.id"
+    )
+    currency: str
+
+    # Mean and standard deviation of the amounts and days between transactions
+    amount: float
+    amount_deviation: float
+    interval_days: float
+    interval_deviation: float
+
+    transaction_count: int
+    first_booking_time: datetime
+    last_booking_time: datetime
+    next_booking_time: datetime
+
+    __table_args__ = (
+        Index(
+            "ix_recurring_series_group",
+            "account_id",
+            text("coalesce(opposing_merchant_id, '')"),
+            text("coalesce(opposing_counterparty_id, '')"),
+            unique=True,
+        ),
+    )
+
+
+class RecurringSeries(RecurringSeriesBase, BaseModel, table=True):
+    id: str = Field(default_factory=generate, primary_key=True)
+
+
+class RecurringSeriesRead(RecurringSeriesBase):
+    id: str
@@ -1,7 +1,9 @@
+import uuid
 from datetime import datetime
 from typing import TYPE_CHECKING, Optional
 
 from nanoid import generate
+from sqlalchemy import PrimaryKeyConstraint
 from sqlmodel import Field, Index, Relationship, SQLModel, text
 
 from api.models.enums.transaction import ProcessingStatus
@@ -25,6 +27,8 @@ class TransactionBase(SQLModel):
 
     # Counterparty
     opposing_name: str | None = None
+    # normalize_name(opposing_name), set on import so matching need not redo it
+    opposing_name_normalized: str | None = None
     opposing_iban: str | None = None
     opposing_bban: str | None = None
 
@@ -38,27 +42,16 @@ class TransactionBase(SQLModel):
     gocardless_id: str | None = None
     internal_id: str | None = None
 
-    # Transaction metadata
+    # Transaction metadata, the table is range partitioned by month of booking
+    # time, see api.db.partitions, so it is part of every unique key
     booking_time: datetime = Field(index=True)
     value_time: datetime | None = None
 
-    __table_args__ = (
-        Index(
-            "ix_transaction_unique_identifiers",
-            text("coalesce(gocardless_id, '')"),
-            text("coalesce(internal_id, '')"),
-            unique=True,
-        ),
-        Index(
-            "ix_transaction_account_processing_status",
-            "account_id",
-            "processing_status",
-        ),
-    )
-
 
 class Transaction(TransactionBase, BaseModel, table=True):
-    id: str = Field(default_factory=generate, primary_key=True)
+    id: str = Field(default_factory=generate)
+    # Deduplication key computed on import, see transaction_fingerprint
+    fingerprint: uuid.UUID
 
     account: "Account" = Relationship(
         back_populates="transactions",
@@ -75,6 +68,33 @@ class Transaction(TransactionBase, BaseModel, table=True):
         sa_relationship_kwargs={"foreign_keys": "[Transaction.opposing_account_id]"},
     )
 
+    __table_args__ = (
+        # Partitioned tables need the partition key in the primary key, leading
+        # with id keeps lookups by id alone on its index
+        PrimaryKeyConstraint("id", "booking_time"),
+        Index(
+            "ix_transaction_account_processing_status",
+            "account_id",
+            "processing_status",
+        ),
+        # Changed and per-group transactions of recurring series detection
+        Index("ix_transaction_updated_at", "updated_at"),
+        Index(
+            "ix_transaction_recurring_group",
+            "account_id",
+            text("coalesce(opposing_merchant_id, '')"),
+            text("coalesce(opposing_counterparty_id, '')"),
+            postgresql_where=text("amount < 0"),
+        ),
+        Index(
+            "ix_transaction_fingerprint",
+            "fingerprint",
+            "booking_time",
+            unique=True,
+        ),
+        {"postgresql_partition_by": "RANGE (booking_time)"},
+    )
+
 
 class TransactionCreate(TransactionBase):
     pass
@@ -1,4 +1,13 @@
-from .gocardless import import_requisition
-from .transaction import process_transactions
+from .gocardless import import_requisition, refresh_gocardless_token
+from .partitions import create_transaction_partitions
+from .recurring import detect_recurring_series
+from .transaction import process_pending_transactions, process_transactions
 
-__all__ = ["import_requisition", "process_transactions"]
+__all__ = [
+    "create_transaction_partitions",
+    "detect_recurring_series",
+    "import_requisition",
+    "process_pending_transactions",
+    "process_transactions",
+    "refresh_gocardless_token",
+]
@@ -1,26 +1,48 @@
-from datetime import datetime
-
-from celery import group
-from sqlalchemy import text
+import hashlib
+import uuid
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Any
+
+from celery import Task, group
+from sqlalchemy import DateTime, Uuid, column, text, update, values
+from sqlalchemy.orm import aliased
 from sqlmodel import Session, col, select
 
 from api.core.celery import app
+from api.core.config import settings
 from api.core.exceptions import (
     ConnectionMissingDataError,
     ConnectionNotFoundError,
+    GoCardlessRateLimitError,
     TransactionMissingDataError,
 )
 from api.core.gocardless import (
+    TRANSACTIONS_BATCH_SIZE,
+    TransactionBatches,
     get_account_details,
     get_institution,
     get_requisition,
-    get_transactions,
+    refresh_token,
+    stream_transactions,
 )
+from api.core.normalize import normalize_name
 from api.db.database import engine
-from api.db.utils import upsert_db
+from api.db.utils import MAX_BIND_PARAMETERS, copy_upsert_db, upsert_db
 from api.models.account import Account, AccountType, ISOAccountType
 from api.models.connection import Connection
 from api.models.transaction import ProcessingStatus, Transaction
+from api.schemas.gocardless import AccountDetails, Institution
+
+from .recurring import mark_shrunk_groups
+from .transaction import schedule_processing
+
+# Rows per COPY load, large enough to amortise the staging table
+BULK_BATCH_SIZE = 20000
+
+# Furthest a bank moves the booking time of a reported transaction
+REBOOKING_WINDOW = timedelta(days=31)
 
 account_index_elements = ["internal_id"]
 account_columns = Account.model_fields.keys()
@@ -34,23 +56,34 @@ account_exclude_columns = {
     "name",
     "notes",
     "balance_offset",
+    "transactions_synced_until",  # Advanced after the transactions are stored
 }
 account_update_columns = [
     col for col in account_columns if col not in account_exclude_columns
 ]
 
-transaction_index_elements = [
-    text("coalesce(gocardless_id, '')"),
-    text("coalesce(internal_id, '')"),
+# Link columns before a change resets them, to find the recurring groups losing
+# the transaction
+transaction_group_columns = [
+    "account_id",
+    "opposing_merchant_id",
+    "opposing_counterparty_id",
+    "amount",
 ]
+
+# booking_time partitions the table, so it is part of the unique key
+transaction_index_elements = ["fingerprint", "booking_time"]
 transaction_columns = Transaction.model_fields.keys()
 transaction_exclude_columns = {
     "id",
     "created_at",
     "updated_at",  # We handle this manually with text("now()")
     "account_id",
+    "opposing_merchant_id",  # Reset on change
     "opposing_counterparty_id",  # Reset on change
     "opposing_account_id",  # Reset on change
+    "fingerprint",
+    "booking_time",
     "gocardless_id",
     "internal_id",
     "processing_status",  # Reset to UNPROCESSED on change
@@ -60,130 +93,388 @@ transaction_update_columns = [
 ]
 
 
+class GoCardlessTask(Task):
+    """Reschedules the task once an exhausted GoCardless rate limit resets."""
+
+    max_retries = 10
+
+    def __call__(self, *args, **kwargs):
+        try:
+            return super().__call__(*args, **kwargs)
+        except GoCardlessRateLimitError as e:
+            raise self.retry(exc=e, countdown=e.retry_after) from e
+
+
 @app.task
-def import_account(account_id: str, connection_id: str, institution_id: str) -> None:
+def refresh_gocardless_token() -> None:
+    """Renew the access token before it expires so imports never wait on it."""
+    refresh_token(min_ttl=settings.GOCARDLESS_TOKEN_REFRESH_AHEAD)
+
+
+@app.task(base=GoCardlessTask)
+def import_account(
+    account_id: str,
+    connection_id: str,
+    institution_id: str,
+    full_resync: bool = False,
+    bulk_load: bool | None = None,
+) -> dict[str, int]:
+    """
+    Import an account and its booked transactions.
+
+    Only transactions booked since the account's sync watermark (minus
+    GOCARDLESS_SYNC_OVERLAP_DAYS) are fetched, unless ``full_resync`` is set
+    or the account has never been synced.
+
+    ``bulk_load`` loads transactions through COPY and a staging table instead
+    of VALUES upserts, by default whenever the full history is fetched.
+    """
     with Session(engine) as session:
-        details = get_account_details(account_id)
-        transactions = get_transactions(account_id)
-
-        institution = get_institution(institution_id)
-
-        fallback_name = f"{institution.name} {details.currency}"
-
-        db_account = Account(
-            connection_id=connection_id,
-            name=details.displayName or details.name or fallback_name,
-            currency=details.currency,
-            account_type=AccountType.BANK_GOCARDLESS,
-            balance_offset=0.0,
-            iban=details.iban,
-            bban=details.bban,
-            bic=details.bic,
-            scan_code=details.scan,
-            internal_id=account_id,
-            owner_name=details.ownerName,
-            usage_type=details.usage,
-            iso_account_type=ISOAccountType(details.cashAccountType),
-        )
-
-        upsert_db(
-            [db_account.model_dump()],
-            session,
-            model=Account,
-            update_whitelist=account_update_columns,
-            index_elements=account_index_elements,
-            update_override={"updated_at": text("now()")},
-        )
+        date_from = None
+        if not full_resync:
+            watermark = session.exec(
+                select(col(Account.transactions_synced_until)).where(
+                    Account.internal_id == account_id
+                )
+            ).first()
 
-        account_mapping = {
-            account.internal_id: account.id
-            for account in session.exec(
-                select(Account).where(
-                    Account.connection_id == connection_id,
-                    col(Account.internal_id).isnot(None),
+            if watermark:
+                date_from = watermark - timedelta(
+                    days=settings.GOCARDLESS_SYNC_OVERLAP_DAYS
                 )
+
+        if bulk_load is None:
+            bulk_load = date_from is None
+
+        upsert = copy_upsert_db if bulk_load else upsert_db
+        batch_size = BULK_BATCH_SIZE if bulk_load else TRANSACTIONS_BATCH_SIZE
+
+        # Independent requests, the account row is stored as soon as the
+        # details arrive while the transactions are still in flight
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            details_future = executor.submit(get_account_details, account_id)
+            institution_future = executor.submit(get_institution, institution_id)
+            transactions_future = executor.submit(
+                stream_transactions,
+                account_id,
+                date_from=date_from,
+                batch_size=batch_size,
             )
+
+            try:
+                _import_account_details(
+                    session,
+                    account_id,
+                    connection_id,
+                    details_future.result(),
+                    institution_future,
+                )
+                transaction_batches = transactions_future.result()
+            except BaseException:
+                transactions_future.add_done_callback(_close_transaction_batches)
+                raise
+
+        with transaction_batches:
+            account_mapping = {
+                account.internal_id: account.id
+                for account in session.exec(
+                    select(Account).where(
+                        Account.connection_id == connection_id,
+                        col(Account.internal_id).isnot(None),
+                    )
+                )
+            }
+
+            synced_until = None
+            inserted = updated = unchanged = 0
+            changed_ids: list[str] = []
+            occurrences: Counter[bytes] = Counter()
+
+            for batch in transaction_batches:
+                transactions_to_upsert = [
+                    _to_db_transaction(
+                        transaction, account_mapping[account_id], occurrences
+                    )
+                    for transaction in batch
+                ]
+
+                booking_times = [
+                    transaction["booking_time"]
+                    for transaction in transactions_to_upsert
+                ]
+                _move_rebooked(session, transactions_to_upsert)
+
+                result = upsert(
+                    transactions_to_upsert,
+                    session,
+                    model=Transaction,
+                    update_whitelist=transaction_update_columns,
+                    index_elements=transaction_index_elements,
+                    update_override={
+                        "updated_at": text("now()"),
+                        "processing_status": ProcessingStatus.UNPROCESSED.value,
+                        "opposing_merchant_id": None,
+                        "opposing_counterparty_id": None,
+                        "opposing_account_id": None,
+                    },
+                    return_ids=True,
+                    return_previous=transaction_group_columns,
+                )
+                mark_shrunk_groups(
+                    (account, merchant_id or "", counterparty_id or "")
+                    for account, merchant_id, counterparty_id, amount in result.previous
+                    if (merchant_id or counterparty_id) and amount < 0
+                )
+
+                latest_booking = max(booking_times).date()
+                if synced_until is None or latest_booking > synced_until:
+                    synced_until = latest_booking
+
+                inserted += result.inserted
+                updated += result.updated
+                unchanged += result.unchanged
+                changed_ids.extend(result.changed_ids)
+
+        stats = {
+            "inserted_transactions": inserted,
+            "updated_transactions": updated,
+            "unchanged_transactions": unchanged,
         }
 
-        transactions_to_upsert = []
+        if synced_until is None:
+            return stats
 
-        for transaction in transactions.booked:
-            opposing_account = (
-                transaction.creditorAccount
-                if transaction.transactionAmount.amount < 0
-                else transaction.debitorAccount
+        session.execute(
+            update(Account)
+            .where(col(Account.internal_id) == account_id)
+            .values(transactions_synced_until=synced_until)
+        )
+        session.commit()
+
+        # Enrich exactly the rows this import created or changed
+        if changed_ids:
+            schedule_processing(account_mapping[account_id], changed_ids)
+
+        return stats
+
+
+def _import_account_details(
+    session: Session,
+    account_id: str,
+    connection_id: str,
+    details: AccountDetails,
+    institution_future: Future[Institution],
+) -> None:
+    # The institution only matters when the bank reports no account name
+    name = details.displayName or details.name
+    if not name:
+        name = f"{institution_future.result().name} {details.currency}"
+
+    user_id = session.exec(
+        select(Connection.user_id).where(Connection.id == connection_id)
+    ).one()
+
+    db_account = Account(
+        connection_id=connection_id,
+        user_id=user_id,
+        name=name,
+        currency=details.currency,
+        account_type=AccountType.BANK_GOCARDLESS,
+        balance_offset=0.0,
+        iban=details.iban,
+        bban=details.bban,
+        bic=details.bic,
+        scan_code=details.scan,
+        internal_id=account_id,
+        owner_name=details.ownerName,
+        usage_type=details.usage,
+        iso_account_type=ISOAccountType(details.cashAccountType),
+    )
+
+    upsert_db(
+        [db_account.model_dump()],
+        session,
+        model=Account,
+        update_whitelist=account_update_columns,
+        index_elements=account_index_elements,
+        update_override={"updated_at": text("now()")},
+    )
+
+
+def _close_transaction_batches(future: Future[TransactionBatches]) -> None:
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+def _move_rebooked(session: Session, transactions: list[dict[str, Any]]) -> int:
+    """
+    Move stored transactions that are now reported with another booking time,
+    at most REBOOKING_WINDOW away, to that booking time.
+
+    The booking time is part of the unique key, so these would otherwise be
+    stored a second time. Updating it moves the row to the partition of its
+    new booking time with its ID and links. Only transactions keyed by their
+    IDs can move, see transaction_fingerprint.
+    """
+    rebookable = [
+        (transaction["fingerprint"], transaction["booking_time"])
+        for transaction in transactions
+        if transaction["gocardless_id"] or transaction["internal_id"]
+    ]
+    if not rebookable:
+        return 0
+
+    moved = 0
+    batch_size = MAX_BIND_PARAMETERS // 2
+    for start in range(0, len(rebookable), batch_size):
+        batch = rebookable[start : start + batch_size]
+        booking_times = [booking_time for _, booking_time in batch]
+        rebooked = values(
+            column("fingerprint", Uuid),
+            column("booking_time", DateTime(timezone=True)),
+            name="rebooked",
+        ).data(batch)
+
+        # Already stored at the new booking time, the upsert updates that row
+        stored = aliased(Transaction, name="stored")
+        already_stored = (
+            select(stored.id)
+            .where(
+                stored.fingerprint == rebooked.c.fingerprint,
+                stored.booking_time == rebooked.c.booking_time,
             )
+            .exists()
+        )
 
-            opposing_name = (
-                transaction.creditorName
-                if transaction.transactionAmount.amount < 0
-                else transaction.debitorName
+        moved += session.execute(
+            update(Transaction)
+            .where(
+                col(Transaction.fingerprint) == rebooked.c.fingerprint,
+                col(Transaction.booking_time) != rebooked.c.booking_time,
+                # Constant bounds let the planner skip the other partitions
+                col(Transaction.booking_time).between(
+                    min(booking_times) - REBOOKING_WINDOW,
+                    max(booking_times) + REBOOKING_WINDOW,
+                ),
+                col(Transaction.booking_time).between(
+                    rebooked.c.booking_time - REBOOKING_WINDOW,
+                    rebooked.c.booking_time + REBOOKING_WINDOW,
+                ),
+                ~already_stored,
             )
+            .values(booking_time=rebooked.c.booking_time)
+            .execution_options(synchronize_session=False)
+        ).rowcount  # type: ignore[attr-defined]
+
+    return moved
+
+
+def transaction_fingerprint(
+    fields: dict[str, Any], occurrences: Counter[bytes]
+) -> uuid.UUID:
+    """
+    Derive the 128-bit deduplication key of a transaction from its ``fields``.
+
+    Transactions with a bank or GoCardless ID are keyed by account and IDs,
+    so corrections to their other fields update the stored row. Others are
+    keyed by their content plus how often that content was already seen in
+    this import, which keeps genuinely repeated transactions apart.
+    """
+    if fields["gocardless_id"] or fields["internal_id"]:
+        content = _fingerprint_content(
+            "id",
+            fields["account_id"],
+            fields["gocardless_id"],
+            fields["internal_id"],
+        )
+    else:
+        content = _fingerprint_content(
+            "content",
+            fields["account_id"],
+            repr(fields["amount"]),
+            fields["currency"],
+            fields["booking_time"].isoformat(),
+            fields["opposing_name"],
+            fields["opposing_iban"],
+            fields["opposing_bban"],
+        )
+        occurrence = occurrences[content]
+        occurrences[content] += 1
+        content += _fingerprint_content(str(occurrence))
 
-            opposing_iban = opposing_account.iban if opposing_account else None
-            opposing_bban = opposing_account.bban if opposing_account else None
+    return uuid.UUID(bytes=hashlib.blake2b(content, digest_size=16).digest())
 
-            booking_time_str = transaction.bookingDateTime or transaction.bookingDate
-            value_time_str = transaction.valueDateTime or transaction.valueDate
 
-            if not booking_time_str:
-                raise TransactionMissingDataError(
-                    transaction.transactionId, "booking date"
-                )
+def _fingerprint_content(*parts: str | None) -> bytes:
+    # Unit separators keep ("ab", "c") and ("a", "bc") apart
+    return b"".join((part or "").encode() + b"\x1f" for part in parts)
 
-            booking_time = datetime.fromisoformat(booking_time_str)
-
-            if value_time_str:
-                value_time = datetime.fromisoformat(value_time_str)
-            else:
-                value_time = None
-
-            native_amount = transaction.transactionAmount.amount
-
-            if transaction.currencyExchange:
-                amount = transaction.currencyExchange.instructedAmount.amount
-                currency = transaction.currencyExchange.instructedAmount.currency
-
-                if native_amount < 0:
-                    amount = -amount
-            else:
-                amount = transaction.transactionAmount.amount
-                currency = transaction.transactionAmount.currency
-
-            db_transaction = Transaction(
-                account_id=account_mapping[account_id],
-                amount=amount,
-                currency=currency,
-                native_amount=native_amount,
-                processing_status=ProcessingStatus.UNPROCESSED,
-                opposing_name=opposing_name,
-                opposing_iban=opposing_iban,
-                opposing_bban=opposing_bban,
-                gocardless_id=transaction.internalTransactionId,
-                internal_id=transaction.transactionId,
-                booking_time=booking_time,
-                value_time=value_time,
-            )
 
-            transactions_to_upsert.append(db_transaction.model_dump())
-
-        upsert_db(
-            transactions_to_upsert,
-            session,
-            model=Transaction,
-            update_whitelist=transaction_update_columns,
-            index_elements=transaction_index_elements,
-            update_override={
-                "updated_at": text("now()"),
-                "processing_status": ProcessingStatus.UNPROCESSED.value,
-                "opposing_counterparty_id": None,
-                "opposing_account_id": None,
-            },
-        )
+def _to_db_transaction(
+    transaction: Any, db_account_id: str, occurrences: Counter[bytes]
+) -> dict[str, Any]:
+    opposing_account = (
+        transaction.creditorAccount
+        if transaction.transactionAmount.amount < 0
+        else transaction.debitorAccount
+    )
 
+    opposing_name = (
+        transaction.creditorName
+        if transaction.transactionAmount.amount < 0
+        else transaction.debitorName
+    )
 
-@app.task
-def import_requisition(connection_id: str) -> str:
+    opposing_iban = opposing_account.iban if opposing_account else None
+    opposing_bban = opposing_account.bban if opposing_account else None
+
+    booking_time_str = transaction.bookingDateTime or transaction.bookingDate
+    value_time_str = transaction.valueDateTime or transaction.valueDate
+
+    if not booking_time_str:
+        raise TransactionMissingDataError(transaction.transactionId, "booking date")
+
+    booking_time = datetime.fromisoformat(booking_time_str)
+
+    value_time = datetime.fromisoformat(value_time_str) if value_time_str else None
+
+    native_amount = transaction.transactionAmount.amount
+
+    if transaction.currencyExchange:
+        amount = transaction.currencyExchange.instructedAmount.amount
+        currency = transaction.currencyExchange.instructedAmount.currency
+
+        if native_amount < 0:
+            amount = -amount
+    else:
+        amount = transaction.transactionAmount.amount
+        currency = transaction.transactionAmount.currency
+
+    fields: dict[str, Any] = {
+        "account_id": db_account_id,
+        "amount": amount,
+        "currency": currency,
+        "native_amount": native_amount,
+        "processing_status": ProcessingStatus.UNPROCESSED,
+        "opposing_name": opposing_name,
+        "opposing_name_normalized": normalize_name(opposing_name),
+        "opposing_iban": opposing_iban,
+        "opposing_bban": opposing_bban,
+        "gocardless_id": transaction.internalTransactionId,
+        "internal_id": transaction.transactionId,
+        "booking_time": booking_time,
+        "value_time": value_time,
+    }
+
+    db_transaction = Transaction(
+        **fields, fingerprint=transaction_fingerprint(fields, occurrences)
+    )
+
+    return db_transaction.model_dump()
+
+
+@app.task(base=GoCardlessTask)
+def import_requisition(connection_id: str, full_resync: bool = False) -> str:
     with Session(engine) as session:
         connection = session.exec(
             select(Connection).where(Connection.id == connection_id)
@@ -198,7 +489,9 @@ def import_requisition(connection_id: str) -> str:
         account_ids = get_requisition(connection.internal_id).accounts
 
         account_tasks = group(
-            import_account.s(account_id, connection_id, connection.institution_id)
+            import_account.s(
+                account_id, connection_id, connection.institution_id, full_resync
+            )
             for account_id in account_ids
         )
 
@@ -0,0 +1,13 @@
+from api.core.celery import app
+from api.db.database import engine
+from api.db.partitions import ensure_partitions, partition_window
+
+
+@app.task
+def create_transaction_partitions() -> int:
+    """
+    Create the transaction partitions of the partition window before bookings
+    arrive, so imports never run DDL.
+    """
+    months = partition_window()
+    return ensure_partitions(engine, months[0], months[-1])
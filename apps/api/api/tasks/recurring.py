@@ -0,0 +1,237 @@
+import json
+from collections.abc import Iterable
+from datetime import UTC, datetime, timedelta
+from typing import Any
+
+import numpy as np
+from sqlalchemy import Float, String, cast, column, delete, text, tuple_, values
+from sqlmodel import Session, col, func, or_, select
+
+from api.core.celery import app
+from api.core.config import settings
+from api.core.recurring import SECONDS_PER_DAY, detect_series
+from api.core.redis import redis_client
+from api.db.database import engine
+from api.db.utils import upsert_db
+from api.models.enums.transaction import ProcessingStatus
+from api.models.recurring_series import RecurringSeries
+from api.models.transaction import Transaction
+
+# Start of the last run less RECURRING_WATERMARK_MARGIN, transactions updated
+# before it are accounted for
+RECURRING_WATERMARK_KEY = f"{settings.REDIS_PREFIX}recurring:watermark"
+# Groups that lost transactions since the last run, which leaves no changed
+# transaction in the group to find it by
+RECURRING_SHRUNK_KEY = f"{settings.REDIS_PREFIX}recurring:shrunk"
+
+# Stale groups per DELETE ... USING (VALUES ...), three bind parameters each
+DELETE_BATCH_SIZE = 10000
+
+series_index_elements = [
+    "account_id",
+    text("coalesce(opposing_merchant_id, '')"),
+    text("coalesce(opposing_counterparty_id, '')"),
+]
+series_update_columns = [
+    "currency",
+    "amount",
+    "amount_deviation",
+    "interval_days",
+    "interval_deviation",
+    "transaction_count",
+    "first_booking_time",
+    "last_booking_time",
+    "next_booking_time",
+]
+
+group_columns = (
+    col(Transaction.account_id),
+    func.coalesce(Transaction.opposing_merchant_id, ""),
+    func.coalesce(Transaction.opposing_counterparty_id, ""),
+)
+debit_filter = (
+    col(Transaction.processing_status) == ProcessingStatus.PROCESSED,
+    col(Transaction.amount) < 0,
+    or_(
+        col(Transaction.opposing_merchant_id).is_not(None),
+        col(Transaction.opposing_counterparty_id).is_not(None),
+    ),
+)
+
+
+@app.task
+def detect_recurring_series() -> dict[str, int]:
+    """
+    Detect recurring payments of each account to a merchant or counterparty.
+
+    Only groups with a transaction changed since the previous run, or marked
+    by mark_shrunk_groups, are recomputed, all of them on the first run. Each
+    group's booking times and amounts are loaded as arrays and analysed with
+    NumPy, see detect_series.
+    """
+    with Session(engine) as session:
+        started_at = session.exec(select(func.now())).one()
+        watermark = redis_client.get(RECURRING_WATERMARK_KEY)
+        shrunk = _take_shrunk_groups()
+
+        query = (
+            select(  # type: ignore[call-overload]
+                *group_columns,
+                func.min(Transaction.currency),
+                func.array_agg(
+                    cast(func.extract("epoch", col(Transaction.booking_time)), Float)
+                ),
+                func.array_agg(Transaction.amount),
+            )
+            .where(*debit_filter)
+            .group_by(*group_columns)
+        )
+
+        if watermark:
+            assert isinstance(watermark, str)
+            changed_groups = (
+                select(*group_columns)
+                .where(
+                    *debit_filter,
+                    col(Transaction.updated_at) > datetime.fromisoformat(watermark),
+                )
+                .distinct()
+            )
+            query = query.where(
+                or_(
+                    tuple_(*group_columns).in_(changed_groups),
+                    tuple_(*group_columns).in_(shrunk),
+                )
+            )
+
+        # Marks are only consumed by a committed run
+        try:
+            groups = session.exec(query).all()
+
+            series = []
+            stale_groups = set(shrunk)
+            if groups:
+                counts = np.fromiter((len(row[4]) for row in groups), dtype=np.int64)
+                stats = detect_series(
+                    np.repeat(np.arange(len(groups)), counts),
+                    np.concatenate([row[4] for row in groups]).astype(np.float64),
+                    np.concatenate([row[5] for row in groups]).astype(np.float64),
+                )
+
+                stale_groups.update(tuple(row[:3]) for row in groups)
+                for i, group_code in enumerate(stats.group):
+                    stale_groups.discard(tuple(groups[group_code][:3]))
+                    series.append(
+                        _to_db_series(
+                            groups[group_code],
+                            stats.transaction_count[i],
+                            stats.first_time[i],
+                            stats.last_time[i],
+                            stats.interval_days[i],
+                            stats.interval_deviation[i],
+                            stats.amount[i],
+                            stats.amount_deviation[i],
+                        )
+                    )
+
+            removed_count = _delete_series(session, list(stale_groups))
+            result = upsert_db(
+                series,
+                session,
+                model=RecurringSeries,
+                update_whitelist=series_update_columns,
+                index_elements=series_index_elements,
+                update_override={"updated_at": text("now()")},
+            )
+            session.commit()
+        except BaseException:
+            mark_shrunk_groups(shrunk)
+            raise
+
+        next_watermark = started_at - timedelta(
+            seconds=settings.RECURRING_WATERMARK_MARGIN
+        )
+        redis_client.set(RECURRING_WATERMARK_KEY, next_watermark.isoformat())
+
+        return {
+            "recurring_series": len(series),
+            "updated_series": result.inserted + result.updated,
+            "removed_series": removed_count,
+        }
+
+
+def mark_shrunk_groups(groups: Iterable[tuple[str, str, str]]) -> None:
+    """
+    Have the next run recompute the ``(account_id, merchant_id,
+    counterparty_id)`` groups that lost transactions, IDs empty when unset.
+    """
+    members = {json.dumps(group) for group in groups}
+    if members:
+        redis_client.sadd(RECURRING_SHRUNK_KEY, *members)
+
+
+def _take_shrunk_groups() -> list[tuple[str, str, str]]:
+    """Remove and return the groups marked since the last run."""
+    # One MULTI, groups marked meanwhile stay for the next run
+    pipeline = redis_client.pipeline()
+    pipeline.smembers(RECURRING_SHRUNK_KEY)
+    pipeline.delete(RECURRING_SHRUNK_KEY)
+    members, _ = pipeline.execute()
+
+    return [tuple(json.loads(member)) for member in members]
+
+
+def _to_db_series(
+    row: Any,
+    transaction_count: int,
+    first_time: float,
+    last_time: float,
+    interval_days: float,
+    interval_deviation: float,
+    amount: float,
+    amount_deviation: float,
+) -> dict[str, Any]:
+    account_id, merchant_id, counterparty_id, currency, *_ = row
+
+    db_series = RecurringSeries(
+        account_id=account_id,
+        opposing_merchant_id=merchant_id or None,
+        opposing_counterparty_id=counterparty_id or None,
+        currency=currency,
+        amount=float(amount),
+        amount_deviation=float(amount_deviation),
+        interval_days=float(interval_days),
+        interval_deviation=float(interval_deviation),
+        transaction_count=int(transaction_count),
+        first_booking_time=datetime.fromtimestamp(first_time, UTC),
+        last_booking_time=datetime.fromtimestamp(last_time, UTC),
+        next_booking_time=datetime.fromtimestamp(
+            last_time + interval_days * SECONDS_PER_DAY, UTC
+        ),
+    )
+
+    return db_series.model_dump()
+
+
+def _delete_series(session: Session, groups: list[tuple[str, str, str]]) -> int:
+    """Delete the series of groups that no longer recur."""
+    deleted = 0
+    for start in range(0, len(groups), DELETE_BATCH_SIZE):
+        stale = values(
+            column("account_id", String),
+            column("merchant_id", String),
+            column("counterparty_id", String),
+            name="stale",
+        ).data(groups[start : start + DELETE_BATCH_SIZE])
+
+        deleted += session.execute(
+            delete(RecurringSeries).where(
+                col(RecurringSeries.account_id) == stale.c.account_id,
+                func.coalesce(RecurringSeries.opposing_merchant_id, "")
+                == stale.c.merchant_id,
+                func.coalesce(RecurringSeries.opposing_counterparty_id, "")
+                == stale.c.counterparty_id,
+            )
+        ).rowcount  # type: ignore[attr-defined]
+
+    return deleted
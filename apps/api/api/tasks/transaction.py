@@ -1,43 +1,377 @@
-from sqlalchemy import update
+import time
+from collections.abc import Sequence
+from contextlib import suppress
+from datetime import timedelta
+from typing import Any
+
+from celery import Task
+from nanoid import generate
+from prometheus_client import Counter, Histogram
+from redis.exceptions import LockError
+from redis.lock import Lock
+from sqlalchemy import (
+    ARRAY,
+    BindParameter,
+    ColumnElement,
+    Float,
+    FromClause,
+    String,
+    any_,
+    bindparam,
+    column,
+    event,
+    insert,
+    text,
+    update,
+    values,
+)
 from sqlmodel import Session, and_, col, func, or_, select
 
 from api.core.celery import app
+from api.core.config import settings
+from api.core.matching import (
+    AccountMatcher,
+    get_account_matcher,
+    get_merchant_matcher,
+    pair_transfers,
+)
+from api.core.normalize import normalize_name
+from api.core.redis import redis_client
 from api.db.database import engine
+from api.db.utils import MAX_BIND_PARAMETERS
 from api.models.account import Account
+from api.models.connection import Connection
+from api.models.counterparty import Counterparty
 from api.models.enums.transaction import ProcessingStatus
-from api.models.merchant import Merchant
 from api.models.transaction import Transaction
 
+# Rows per UPDATE ... FROM (VALUES ...), two bind parameters each
+UPDATE_BATCH_SIZE = 10000
+
+# Pending set member requesting a run over every unprocessed transaction
+PENDING_ALL = "*"
+
+# Advisory lock class of the per-user lock of stages writing beyond the
+# account, transfer pairing and counterparty creation
+USER_LOCK_ID = 0x636F756E
 
-@app.task
-def process_transactions(account_id: str) -> dict[str, int]:
+STAGE_SECONDS = Histogram(
+    "enrichment_stage_seconds",
+    "Time spent in each transaction enrichment stage per batch.",
+    ["stage"],
+)
+STAGE_ROWS = Counter(
+    "enrichment_stage_rows",
+    "Transactions scanned and matched by each enrichment stage.",
+    ["stage", "outcome"],
+)
+STAGE_STATEMENTS = Counter(
+    "enrichment_stage_statements",
+    "SQL statements executed by each enrichment stage.",
+    ["stage"],
+)
+
+
+def schedule_processing(
+    account_id: str, transaction_ids: list[str] | None = None
+) -> None:
+    """
+    Queue transactions of ``account_id`` for enrichment, every unprocessed one
+    when no IDs are given.
+
+    Requests are collected per account and handled by a single
+    process_pending_transactions run, started PROCESSING_DEBOUNCE seconds
+    after the first request, so back-to-back imports share one run.
+    """
+    if transaction_ids == []:
+        return
+
+    pipeline = redis_client.pipeline()
+    pipeline.sadd(
+        _pending_key(account_id),
+        *(transaction_ids if transaction_ids is not None else [PENDING_ALL]),
+    )
+    pipeline.set(
+        _scheduled_key(account_id),
+        "1",
+        nx=True,
+        ex=settings.PROCESSING_LEASE_TIMEOUT,
+    )
+    _, scheduled = pipeline.execute()
+
+    if scheduled:
+        process_pending_transactions.apply_async(
+            (account_id,), countdown=settings.PROCESSING_DEBOUNCE
+        )
+
+
+@app.task(bind=True, max_retries=None)
+def process_pending_transactions(self: Task, account_id: str) -> dict[str, Any]:
+    """Process everything queued for ``account_id`` by schedule_processing."""
+    lease = _acquire_lease(self, account_id)
+
+    try:
+        # Requests arriving from here on schedule a new run. Those taken join
+        # the ones a failed run left behind, which the next run retries
+        pipeline = redis_client.pipeline()
+        pipeline.delete(_scheduled_key(account_id))
+        pipeline.sunionstore(
+            _running_key(account_id),
+            [_running_key(account_id), _pending_key(account_id)],
+        )
+        pipeline.delete(_pending_key(account_id))
+        pipeline.smembers(_running_key(account_id))
+        *_, pending = pipeline.execute()
+
+        if not pending:
+            return {"processed_transactions": 0, "stages": {}}
+
+        transaction_ids = None if PENDING_ALL in pending else sorted(pending)
+        result = _process_transactions(account_id, transaction_ids, lease)
+
+        redis_client.delete(_running_key(account_id))
+        return result
+    finally:
+        with suppress(LockError):
+            lease.release()
+
+
+@app.task(bind=True, max_retries=None)
+def process_transactions(
+    self: Task, account_id: str, transaction_ids: list[str] | None = None
+) -> dict[str, Any]:
     """
     Enrich transactions with merchant, counterpart, and account information.
 
     The priority order is: Account, Merchant, Counterparty.
 
     This means that first we check if the transaction is between accounts,
-    if not we try to match it to a merchant, and if that fails,
-    we link it to an existing or new counterparty.
+    either by the opposing IBAN/BBAN or by an opposite transaction on another
+    of the user's accounts, if not we try to match it to a merchant, and if
+    that fails, we link it to an existing or new counterparty. Transactions
+    with nothing to match on are marked processed as they are, so later runs
+    skip them.
+
+    When ``transaction_ids`` is given only those transactions are considered,
+    otherwise every unprocessed transaction of the account. Such backlog runs
+    match accounts against an in-memory map of the user's accounts instead
+    of joining in the database.
+
+    Only one run per account executes at a time, others are retried later.
+    Transactions are processed in batches of PROCESSING_BATCH_SIZE IDs, each
+    committed on its own.
     """
+    lease = _acquire_lease(self, account_id)
+
+    try:
+        return _process_transactions(account_id, transaction_ids, lease)
+    finally:
+        with suppress(LockError):
+            lease.release()
+
+
+def _process_transactions(
+    account_id: str, transaction_ids: list[str] | None, lease: Lock
+) -> dict[str, Any]:
     with Session(engine) as session:
+        user_id = session.exec(
+            select(Connection.user_id)
+            .join(Account, col(Account.connection_id) == Connection.id)
+            .where(Account.id == account_id)
+        ).one()
+
+        accounts = None
+        if transaction_ids is None:
+            accounts = get_account_matcher(session, user_id)
+
+        stages: dict[str, dict[str, Any]] = {}
+        last_id = None
+        while True:
+            # Keyset pagination over the IDs still to process
+            batch_query = (
+                select(Transaction.id)
+                .where(*_unprocessed_filter(account_id, transaction_ids))
+                .order_by(col(Transaction.id))
+                .limit(settings.PROCESSING_BATCH_SIZE)
+            )
+            if last_id is not None:
+                batch_query = batch_query.where(col(Transaction.id) > last_id)
+
+            batch_ids = list(session.exec(batch_query).all())
+            if not batch_ids:
+                break
+
+            _process_batch(session, account_id, user_id, batch_ids, accounts, stages)
+            session.commit()
+
+            last_id = batch_ids[-1]
+            lease.extend(settings.PROCESSING_LEASE_TIMEOUT, replace_ttl=True)
+
+        return {
+            "processed_transactions": sum(
+                stage["matched"] for stage in stages.values()
+            ),
+            "stages": stages,
+        }
+
+
+def _process_batch(
+    session: Session,
+    account_id: str,
+    user_id: str,
+    transaction_ids: list[str],
+    accounts: AccountMatcher | None,
+    stages: dict[str, dict[str, Any]],
+) -> None:
+    """Run every stage over one batch, adding their statistics to ``stages``."""
+    remaining = len(transaction_ids)
+
+    for name, stage, args in (
         # First, try to bulk process account linkings
-        processed_count = _bulk_link_accounts(session, account_id)
-        processed_count += _bulk_link_merchants(session, account_id)
+        ("accounts", _bulk_link_accounts, (user_id, transaction_ids, accounts)),
+        ("transfers", _pair_transfers, (user_id, transaction_ids)),
+        ("merchants", _bulk_link_merchants, (transaction_ids,)),
+        ("counterparties", _bulk_link_counterparties, (user_id, transaction_ids)),
+        ("settle", _settle_remaining, (transaction_ids,)),
+    ):
+        statements = 0
+
+        def count_statement(*_: Any) -> None:
+            nonlocal statements
+            statements += 1
 
-        # TODO: Continue with remaining unprocessed transactions
-        # - Process counterparty matches
+        connection = session.connection()
+        event.listen(connection, "before_cursor_execute", count_statement)
+        start = time.perf_counter()
+        try:
+            matched = stage(session, account_id, *args)
+        finally:
+            seconds = time.perf_counter() - start
+            event.remove(connection, "before_cursor_execute", count_statement)
 
-        session.commit()
-        return {"processed_transactions": processed_count}
+        scanned = remaining
+        remaining -= matched
 
+        totals = stages.setdefault(
+            name,
+            {
+                "seconds": 0.0,
+                "scanned": 0,
+                "matched": 0,
+                "unprocessed": 0,
+                "statements": 0,
+            },
+        )
+        totals["seconds"] += seconds
+        totals["scanned"] += scanned
+        totals["matched"] += matched
+        totals["unprocessed"] = totals["scanned"] - totals["matched"]
+        totals["statements"] += statements
 
-def _bulk_link_accounts(session: Session, account_id: str) -> int:
+        STAGE_SECONDS.labels(stage=name).observe(seconds)
+        STAGE_ROWS.labels(stage=name, outcome="scanned").inc(scanned)
+        STAGE_ROWS.labels(stage=name, outcome="matched").inc(matched)
+        STAGE_STATEMENTS.labels(stage=name).inc(statements)
+
+
+def _settle_remaining(
+    session: Session, account_id: str, transaction_ids: list[str] | None = None
+) -> int:
+    """Mark whatever is left processed, it has no identifiers to match on."""
+    return session.execute(
+        update(Transaction)
+        .where(*_unprocessed_filter(account_id, transaction_ids))
+        .values(processing_status=ProcessingStatus.PROCESSED)
+        .execution_options(synchronize_session=False)
+    ).rowcount  # type: ignore[attr-defined]
+
+
+def _acquire_lease(task: Task, account_id: str) -> Lock:
+    lease = redis_client.lock(
+        f"{settings.REDIS_PREFIX}processing:lease:{account_id}",
+        timeout=settings.PROCESSING_LEASE_TIMEOUT,
+    )
+
+    if not lease.acquire(blocking=False):
+        # Another worker is processing this account
+        raise task.retry(countdown=settings.PROCESSING_DEBOUNCE)
+
+    return lease
+
+
+def _lock_user(session: Session, user_id: str) -> None:
+    """Serialize with other runs for the user's accounts until the batch commits."""
+    session.execute(
+        text("SELECT pg_advisory_xact_lock(:lock_id, hashtext(:user_id))"),
+        {"lock_id": USER_LOCK_ID, "user_id": user_id},
+    )
+
+
+def _pending_key(account_id: str) -> str:
+    return f"{settings.REDIS_PREFIX}processing:pending:{account_id}"
+
+
+def _running_key(account_id: str) -> str:
+    return f"{settings.REDIS_PREFIX}processing:running:{account_id}"
+
+
+def _scheduled_key(account_id: str) -> str:
+    return f"{settings.REDIS_PREFIX}processing:scheduled:{account_id}"
+
+
+def _unprocessed_filter(
+    account_id: str, transaction_ids: list[str] | None
+) -> list[ColumnElement[bool]]:
+    filters = [
+        col(Transaction.account_id) == account_id,
+        col(Transaction.processing_status) == ProcessingStatus.UNPROCESSED,
+    ]
+
+    if transaction_ids is not None:
+        # One array parameter instead of one bind parameter per ID
+        filters.append(
+            col(Transaction.id)
+            == any_(bindparam("transaction_ids", transaction_ids, type_=ARRAY(String)))
+        )
+
+    return filters
+
+
+def _bulk_link_accounts(
+    session: Session,
+    account_id: str,
+    user_id: str,
+    transaction_ids: list[str] | None = None,
+    accounts: AccountMatcher | None = None,
+) -> int:
     """
-    Bulk link transactions to opposing accounts when exactly one account matches.
+    Bulk link transactions to opposing accounts when exactly one account of
+    the same user matches.
 
-    Returns the number of transactions that were successfully linked.
+    Matches against ``accounts`` in memory when given, otherwise in the
+    database. Returns the number of transactions that were successfully linked.
     """
+    if accounts is not None:
+        candidates = session.exec(
+            select(
+                Transaction.id, Transaction.opposing_iban, Transaction.opposing_bban
+            ).where(
+                *_unprocessed_filter(account_id, transaction_ids),
+                or_(
+                    col(Transaction.opposing_iban).is_not(None),
+                    col(Transaction.opposing_bban).is_not(None),
+                ),
+            )
+        ).all()
+
+        matches = []
+        for transaction_id, opposing_iban, opposing_bban in candidates:
+            opposing_account_id = accounts.match(opposing_iban, opposing_bban)
+            if opposing_account_id is not None:
+                matches.append((transaction_id, opposing_account_id))
+
+        return _update_matches(session, matches, "opposing_account_id")
+
     match_subquery = (
         select(
             col(Transaction.id).label("transaction_id"),
@@ -49,116 +383,359 @@ def _bulk_link_accounts(session: Session, account_id: str) -> int:
         .select_from(Transaction)
         .join(
             Account,
-            or_(
-                and_(
-                    col(Transaction.opposing_iban).is_not(None),
-                    Transaction.opposing_iban == Account.iban,
-                ),
-                and_(
-                    col(Transaction.opposing_bban).is_not(None),
-                    Transaction.opposing_bban == Account.bban,
+            and_(
+                Account.user_id == user_id,
+                or_(
+                    and_(
+                        col(Transaction.opposing_iban).is_not(None),
+                        Transaction.opposing_iban == Account.iban,
+                    ),
+                    and_(
+                        col(Transaction.opposing_bban).is_not(None),
+                        Transaction.opposing_bban == Account.bban,
+                    ),
                 ),
             ),
         )
-        .where(
-            Transaction.account_id == account_id,
-            Transaction.processing_status == ProcessingStatus.UNPROCESSED,
-        )
+        .where(*_unprocessed_filter(account_id, transaction_ids))
     ).subquery()
 
-    # Get transactions with exactly one account match
-    exact_matches = session.exec(
-        select(match_subquery.c.transaction_id, match_subquery.c.account_id).where(
-            match_subquery.c.match_count == 1
-        )
-    ).all()
+    # Transactions with exactly one account match
+    exact_matches = (
+        select(match_subquery.c.transaction_id, match_subquery.c.account_id)
+        .where(match_subquery.c.match_count == 1)
+        .subquery()
+    )
+
+    return _update_from(
+        session,
+        exact_matches,
+        opposing_account_id=exact_matches.c.account_id,
+        processing_status=ProcessingStatus.PROCESSED,
+    )
+
+
+def _pair_transfers(
+    session: Session,
+    account_id: str,
+    user_id: str,
+    transaction_ids: list[str] | None = None,
+) -> int:
+    """
+    Link transfers to and from the user's other accounts that carry no account
+    identifiers, by pairing them with an opposite transaction on that account.
+
+    The account's unprocessed transactions are paired with transactions of
+    any status on the other accounts, as those may have been processed by an
+    earlier run. Neither side may carry opposing identifiers or links, and
+    names matching a merchant are left to the merchant stage. Both sides are
+    linked. Returns the number of the account's transactions that were linked.
+    """
+    window = timedelta(days=settings.TRANSFER_MATCH_WINDOW_DAYS)
+    matcher = get_merchant_matcher(session)
+
+    unpaired = (
+        col(Transaction.opposing_iban).is_(None),
+        col(Transaction.opposing_bban).is_(None),
+        col(Transaction.opposing_account_id).is_(None),
+        col(Transaction.opposing_merchant_id).is_(None),
+        col(Transaction.opposing_counterparty_id).is_(None),
+        col(Transaction.amount) != 0,
+    )
 
-    if not exact_matches:
+    def is_merchant(row: Any) -> bool:
+        # Rows imported before the column existed are normalized here
+        name = row.opposing_name_normalized or normalize_name(row.opposing_name)
+        return name is not None and matcher.match(name) is not None
+
+    transactions = [
+        row
+        for row in session.exec(
+            select(  # type: ignore[call-overload]
+                Transaction.id,
+                Transaction.currency,
+                Transaction.amount,
+                Transaction.booking_time,
+                Transaction.opposing_name_normalized,
+                Transaction.opposing_name,
+            ).where(*_unprocessed_filter(account_id, transaction_ids), *unpaired)
+        ).all()
+        if not is_merchant(row)
+    ]
+
+    if not transactions:
         return 0
 
-    transaction_updates = []
-    for match in exact_matches:
-        transaction_updates.append(
-            {
-                "id": match.transaction_id,  # type: ignore[attr-defined]
-                "opposing_account_id": match.account_id,  # type: ignore[attr-defined]
-                "processing_status": ProcessingStatus.PROCESSED,
-            }
-        )
+    # Runs for the user's other accounts pair against these rows too
+    _lock_user(session, user_id)
 
-    if transaction_updates:
-        for update_data in transaction_updates:
-            session.execute(
-                update(Transaction)
-                .where(Transaction.id == update_data["id"])
-                .values(
-                    opposing_account_id=update_data.get("opposing_account_id"),
-                    processing_status=update_data["processing_status"],
-                )
+    amounts = list({abs(amount) for _, _, amount, *_ in transactions})
+    booking_times = [booking_time for _, _, _, booking_time, *_ in transactions]
+    candidates = [
+        row
+        for row in session.exec(
+            select(  # type: ignore[call-overload]
+                Transaction.id,
+                Transaction.account_id,
+                Transaction.currency,
+                Transaction.amount,
+                Transaction.booking_time,
+                Transaction.opposing_name_normalized,
+                Transaction.opposing_name,
+            )
+            .join(Account, col(Account.id) == Transaction.account_id)
+            .where(
+                Account.user_id == user_id,
+                Account.id != account_id,
+                *unpaired,
+                func.abs(Transaction.amount)
+                == any_(bindparam("amounts", amounts, type_=ARRAY(Float))),
+                col(Transaction.booking_time).between(
+                    min(booking_times) - window, max(booking_times) + window
+                ),
             )
+        ).all()
+        if not is_merchant(row)
+    ]
+
+    pairs = pair_transfers(transactions, candidates, window)
+    if not pairs:
+        return 0
 
-    return len(transaction_updates)
+    candidate_accounts = {
+        candidate_id: candidate_account_id
+        for candidate_id, candidate_account_id, *_ in candidates
+    }
+
+    _update_matches(
+        session,
+        [(candidate_id, account_id) for _, candidate_id in pairs],
+        "opposing_account_id",
+        # Never overwrite a link set since the candidates were read
+        where=unpaired,
+    )
+    return _update_matches(
+        session,
+        [
+            (transaction_id, candidate_accounts[candidate_id])
+            for transaction_id, candidate_id in pairs
+        ],
+        "opposing_account_id",
+    )
 
 
-def _bulk_link_merchants(session: Session, account_id: str) -> int:
+def _bulk_link_merchants(
+    session: Session, account_id: str, transaction_ids: list[str] | None = None
+) -> int:
     """
-    Bulk link transactions to merchants.
+    Bulk link transactions to the merchant with the longest matching prefix.
 
-    Returns the number of transactions that were successfully linked.
+    Names are matched in memory against the cached merchant trie, so the cost
+    does not grow with the merchant catalog. Returns the number of transactions
+    that were successfully linked.
     """
-    match_subquery = (
+    matcher = get_merchant_matcher(session)
+    if not matcher.size:
+        return 0
+
+    candidates = session.exec(
         select(
-            col(Transaction.id).label("transaction_id"),
-            col(Merchant.id).label("merchant_id"),
-            func.length(Merchant.match_prefix).label("prefix_length"),
-            func.row_number()
-            .over(
-                partition_by=Transaction.id,
-                order_by=func.length(Merchant.match_prefix).desc(),
-            )
-            .label("row_number"),  # This is the order of merchants by specificity
-        )
-        .select_from(Transaction)
-        .join(
-            Merchant,
-            col(Transaction.opposing_name).ilike(Merchant.match_prefix + "%"),
-        )
-        .where(
-            Transaction.account_id == account_id,
-            Transaction.processing_status == ProcessingStatus.UNPROCESSED,
+            Transaction.id,
+            Transaction.opposing_name_normalized,
+            Transaction.opposing_name,
+        ).where(
+            *_unprocessed_filter(account_id, transaction_ids),
             col(Transaction.opposing_name).is_not(None),
         )
-        .subquery()
-    )
+    ).all()
+
+    matches = []
+    for transaction_id, normalized_name, opposing_name in candidates:
+        # Rows imported before the column existed are normalized here
+        name = normalized_name or normalize_name(opposing_name)
+        merchant_id = matcher.match(name) if name else None
+        if merchant_id is not None:
+            matches.append((transaction_id, merchant_id))
+
+    return _update_matches(session, matches, "opposing_merchant_id")
+
 
-    best_matches = session.exec(
-        select(match_subquery.c.transaction_id, match_subquery.c.merchant_id).where(
-            match_subquery.c.row_number == 1
+def _bulk_link_counterparties(
+    session: Session,
+    account_id: str,
+    user_id: str,
+    transaction_ids: list[str] | None = None,
+) -> int:
+    """
+    Link the remaining transactions to the user's counterparties, matching by
+    IBAN, then BBAN, then normalized name. Counterparties that do not exist
+    yet are created in bulk.
+
+    Runs for different accounts of one user hold a per-user lock until they
+    commit, so they never create the same counterparty twice.
+
+    Returns the number of transactions that were successfully linked.
+    """
+    candidates = session.exec(
+        select(  # type: ignore[call-overload]
+            Transaction.id,
+            Transaction.opposing_iban,
+            Transaction.opposing_bban,
+            Transaction.opposing_name_normalized,
+            Transaction.opposing_name,
+        ).where(
+            *_unprocessed_filter(account_id, transaction_ids),
+            or_(
+                col(Transaction.opposing_iban).is_not(None),
+                col(Transaction.opposing_bban).is_not(None),
+                col(Transaction.opposing_name).is_not(None),
+            ),
         )
     ).all()
 
-    if not best_matches:
+    if not candidates:
         return 0
 
-    transaction_updates = []
-    for match in best_matches:
-        transaction_updates.append(
-            {
-                "id": match.transaction_id,  # type: ignore[attr-defined]
-                "opposing_merchant_id": match.merchant_id,  # type: ignore[attr-defined]
-                "processing_status": ProcessingStatus.PROCESSED,
-            }
+    # The lookup below then sees the counterparties created by a concurrent
+    # run for the same user
+    _lock_user(session, user_id)
+
+    # Rows imported before the column existed are normalized here
+    candidates = [
+        (transaction_id, iban, bban, normalized_name or normalize_name(name), name)
+        for transaction_id, iban, bban, normalized_name, name in candidates
+    ]
+
+    by_iban: dict[str, str] = {}
+    by_bban: dict[str, str] = {}
+    by_name: dict[str, str] = {}
+
+    def remember(
+        counterparty_id: str, iban: str | None, bban: str | None, name: str | None
+    ) -> None:
+        for lookup, key in ((by_iban, iban), (by_bban, bban), (by_name, name)):
+            if key is not None:
+                lookup.setdefault(key, counterparty_id)
+
+    existing = session.exec(
+        select(
+            Counterparty.id,
+            Counterparty.iban,
+            Counterparty.bban,
+            Counterparty.name_normalized,
+        )
+        .where(
+            Counterparty.creator_id == user_id,
+            or_(
+                col(Counterparty.iban) == any_(_array_param("ibans", candidates, 1)),
+                col(Counterparty.bban) == any_(_array_param("bbans", candidates, 2)),
+                col(Counterparty.name_normalized)
+                == any_(_array_param("names", candidates, 3)),
+            ),
+        )
+        # The oldest counterparty wins when several share an identifier
+        .order_by(col(Counterparty.created_at), col(Counterparty.id))
+    ).all()
+
+    for row in existing:
+        remember(*row)
+
+    matches = []
+    new_counterparties: list[dict[str, Any]] = []
+    for transaction_id, iban, bban, normalized_name, name in candidates:
+        keys = ((by_iban, iban), (by_bban, bban), (by_name, normalized_name))
+        counterparty_id = next(
+            (lookup[key] for lookup, key in keys if key is not None and key in lookup),
+            None,
         )
 
-    if transaction_updates:
-        for update_data in transaction_updates:
+        if counterparty_id is None:
+            if iban is None and bban is None and normalized_name is None:
+                continue
+
+            counterparty_id = generate()
+            new_counterparties.append(
+                {
+                    "id": counterparty_id,
+                    "creator_id": user_id,
+                    "name": name or iban or bban,
+                    "name_normalized": normalized_name,
+                    "iban": iban,
+                    "bban": bban,
+                }
+            )
+            remember(counterparty_id, iban, bban, normalized_name)
+
+        matches.append((transaction_id, counterparty_id))
+
+    if new_counterparties:
+        batch_size = MAX_BIND_PARAMETERS // len(new_counterparties[0])
+        for start in range(0, len(new_counterparties), batch_size):
             session.execute(
-                update(Transaction)
-                .where(Transaction.id == update_data["id"])
-                .values(
-                    opposing_merchant_id=update_data.get("opposing_merchant_id"),
-                    processing_status=update_data["processing_status"],
+                insert(Counterparty).values(
+                    new_counterparties[start : start + batch_size]
                 )
             )
 
-    return len(transaction_updates)
+    return _update_matches(session, matches, "opposing_counterparty_id")
+
+
+def _array_param(name: str, rows: list[Any], index: int) -> BindParameter[Any]:
+    """Bind the distinct non-null ``row[index]`` values as one array parameter."""
+    keys = {row[index] for row in rows if row[index] is not None}
+    return bindparam(name, list(keys), type_=ARRAY(String))
+
+
+def _update_matches(
+    session: Session,
+    matches: list[tuple[str, str]],
+    target: str,
+    where: Sequence[ColumnElement[bool]] = (),
+    **assignments: Any,
+) -> int:
+    """
+    Set ``target`` from ``(transaction_id, value)`` pairs and mark the rows
+    processed, in batches of UPDATE ... FROM (VALUES ...). Rows not matching
+    ``where`` are left alone.
+    """
+    linked = 0
+    for start in range(0, len(matches), UPDATE_BATCH_SIZE):
+        batch = values(
+            column("transaction_id", String),
+            column("value", String),
+            name="matches",
+        ).data(matches[start : start + UPDATE_BATCH_SIZE])
+
+        linked += _update_from(
+            session,
+            batch,
+            where,
+            **{target: batch.c.value},
+            processing_status=ProcessingStatus.PROCESSED,
+            **assignments,
+        )
+
+    return linked
+
+
+def _update_from(
+    session: Session,
+    matches: FromClause,
+    where: Sequence[ColumnElement[bool]] = (),
+    **assignments: Any,
+) -> int:
+    """
+    Apply ``assignments`` to the transactions in ``matches`` matching ``where``
+    in one UPDATE ... FROM.
+
+    ``matches`` must have a ``transaction_id`` column. Returns the number of
+    rows updated as reported by the database.
+    """
+    result = session.execute(
+        update(Transaction)
+        .where(col(Transaction.id) == matches.c.transaction_id, *where)
+        .values(**assignments)
+        # Matched rows are never loaded into the session, nothing to synchronize
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount  # type: ignore[attr-defined]
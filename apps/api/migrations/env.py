@@ -6,6 +6,14 @@ from sqlmodel import SQLModel
 from api import models  # noqa: F401
 from api.core.config import settings
 from api.db.database import engine as app_engine
+from api.db.partitions import (
+    create_partitions,
+    default_partition_ddl,
+    is_partition,
+    is_partitioned,
+    partition_ddl,
+    partition_window,
+)
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
@@ -31,6 +39,20 @@ target_metadata = SQLModel.metadata
 # ... etc.
 
 
+def include_name(name, type_, parent_names):
+    # Transaction partitions are created at runtime, not by migrations
+    return not (type_ == "table" and is_partition(name))
+
+
+def emit_partitions() -> None:
+    # Without a database the default partition cannot be checked for bookings
+    # of these months, so the script suits new databases. It comes last so
+    # it holds none
+    for month in partition_window():
+        context.execute(partition_ddl(month))
+    context.execute(default_partition_ddl())
+
+
 def run_migrations_offline() -> None:
     """Run migrations in 'offline' mode.
 
@@ -49,10 +71,12 @@ def run_migrations_offline() -> None:
         target_metadata=target_metadata,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
+        include_name=include_name,
     )
 
     with context.begin_transaction():
         context.run_migrations()
+        emit_partitions()
 
 
 def run_migrations_online() -> None:
@@ -65,10 +89,18 @@ def run_migrations_online() -> None:
     connectable = app_engine
 
     with connectable.connect() as connection:
-        context.configure(connection=connection, target_metadata=target_metadata)
+        context.configure(
+            connection=connection,
+            target_metadata=target_metadata,
+            include_name=include_name,
+        )
 
         with context.begin_transaction():
             context.run_migrations()
+            # Later months are created by the create_transaction_partitions
+            # task, bookings of these months in the default partition move
+            if is_partitioned(connection):
+                create_partitions(connection, partition_window())
 
 
 if context.is_offline_mode():